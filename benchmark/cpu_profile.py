@@ -0,0 +1,117 @@
+"""Real-time factor of the transcription on CPU for different compute types and thread counts.
+
+Usage: python benchmark/cpu_profile.py audio.mp3 --compute-types int8 float32 --threads 4 8 16
+
+With --pinning the transcription additionally runs on the Whisper share of CPU_SPLIT, once pinned to these
+cores and once unpinned with the same number of threads. It runs alone, so it shows the cost of the smaller
+share but not the gain from keeping the other stages of the pipeline off its cores.
+
+The real-time factor is the processing time divided by the length of the audio, lower is faster.
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+from os.path import abspath, dirname
+
+import torch
+import whisperx
+from whisperx.asr import WhisperModel
+
+sys.path.insert(0, dirname(dirname(abspath(__file__))))
+
+from src.util import load_audio, SAMPLE_RATE  # noqa: E402
+from src.transcription import transcribe_audio, align  # noqa: E402
+
+
+def benchmark_asr(audio, compute_type, threads, batch_size, language):
+    whisper_model = WhisperModel("large-v3", device="cpu", compute_type=compute_type, cpu_threads=threads)
+    model = whisperx.load_model(
+        "large-v3", "cpu", compute_type=compute_type, model=whisper_model, threads=threads
+    )
+    start_time = time.time()
+    result = transcribe_audio(None, audio, model, batch_size=batch_size, language=language)
+    return time.time() - start_time, result
+
+
+def benchmark_alignment(audio, result, threads):
+    torch.set_num_threads(threads)
+    start_time = time.time()
+    align(result, audio, "cpu")
+    return time.time() - start_time
+
+
+def asr_cores(split):
+    """The cores the worker gives Whisper with CPU_SPLIT, see cpu_split() in worker.py."""
+    cores = sorted(os.sched_getaffinity(0))
+    weights = [int(weight) for weight in split.split(":")]
+    return cores[: max(1, len(cores) * weights[0] // sum(weights))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("audio", help="audio or video file to transcribe")
+    parser.add_argument("--compute-types", nargs="+", default=["int8", "int8_float32", "float32"])
+    parser.add_argument("--threads", nargs="+", type=int, default=[os.cpu_count() // 2, os.cpu_count()])
+    parser.add_argument("--batch-size", type=int, default=4)
+    parser.add_argument("--language", default="de")
+    parser.add_argument("--pinning", metavar="CPU_SPLIT", help="compare Whisper pinned to its share, e.g. 2:1:1")
+    parser.add_argument("--output", help="write the results to this JSON file")
+    args = parser.parse_args()
+
+    audio = load_audio(args.audio)
+    duration = len(audio) / SAMPLE_RATE
+    results = []
+    print(f"{'stage':<10} {'compute type':<14} {'threads':>7} {'seconds':>9} {'RTF':>7}")
+    for compute_type in args.compute_types:
+        for threads in args.threads:
+            elapsed, result = benchmark_asr(audio, compute_type, threads, args.batch_size, args.language)
+            results.append(
+                {
+                    "stage": "asr",
+                    "compute_type": compute_type,
+                    "threads": threads,
+                    "seconds": elapsed,
+                    "rtf": elapsed / duration,
+                }
+            )
+            print(f"{'asr':<10} {compute_type:<14} {threads:>7} {elapsed:>9.1f} {elapsed / duration:>7.3f}")
+
+    if args.pinning:
+        cores = asr_cores(args.pinning)
+        all_cores = os.sched_getaffinity(0)
+        compute_type = args.compute_types[0]
+        for pinned in [True, False]:
+            if pinned:
+                os.sched_setaffinity(0, cores)
+            try:
+                elapsed, _ = benchmark_asr(audio, compute_type, len(cores), args.batch_size, args.language)
+            finally:
+                os.sched_setaffinity(0, all_cores)
+            stage = "pinned" if pinned else "unpinned"
+            results.append(
+                {
+                    "stage": f"asr {stage}",
+                    "compute_type": compute_type,
+                    "threads": len(cores),
+                    "seconds": elapsed,
+                    "rtf": elapsed / duration,
+                }
+            )
+            print(f"{'asr ' + stage:<10} {compute_type:<14} {len(cores):>7} {elapsed:>9.1f} {elapsed / duration:>7.3f}")
+
+    # Alignment runs with torch and does not depend on the compute type of Whisper
+    for threads in args.threads:
+        elapsed = benchmark_alignment(audio, result, threads)
+        results.append({"stage": "alignment", "threads": threads, "seconds": elapsed, "rtf": elapsed / duration})
+        print(f"{'alignment':<10} {'-':<14} {threads:>7} {elapsed:>9.1f} {elapsed / duration:>7.3f}")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"audio": args.audio, "duration": duration, "results": results}, f, indent=4)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,260 @@
+"""Benchmark of the transcription pipeline on synthetic audio.
+
+Usage: python benchmark/pipeline.py --seconds 600 --tracks 3 --repeat 3 --output results.json
+
+By default the models are replaced by deterministic stubs, so the benchmark runs offline and measures
+everything around the models: probing, decoding, voice isolation, merging, SRT, editor and download.
+With --real, Whisper, the alignment model and pyannote are used instead, if they are cached locally.
+The results are written as JSON, so runs on different versions can be compared.
+"""
+
+import os
+import sys
+import json
+import time
+import wave
+import shutil
+import zipfile
+import platform
+import argparse
+import tempfile
+import subprocess
+from os.path import abspath, dirname, join
+
+import numpy as np
+
+REPO = dirname(dirname(abspath(__file__)))
+sys.path.insert(0, REPO)
+
+SAMPLE_RATE = 16000
+WORDS = "der die das und oder nicht ist ein eine zu mit von auf für im den sich des dem".split()
+
+
+def synthetic_tracks(seconds, tracks, seed=0):
+    """One track per speaker. The speakers take turns every few seconds, a quiet bleed of the others stays."""
+    rng = np.random.default_rng(seed)
+    t = np.arange(int(seconds * SAMPLE_RATE)) / SAMPLE_RATE
+    turn = ((t // 4) % tracks).astype(int)
+    result = []
+    for track in range(tracks):
+        # Noise modulated at a syllable rate sounds enough like speech for the voice activity detection
+        voice = rng.standard_normal(len(t)) * (0.5 + 0.5 * np.sin(2 * np.pi * 4 * t)) * 0.2
+        gain = np.where(turn == track, 1.0, 0.05)
+        result.append((voice * gain).astype(np.float32))
+    return result
+
+
+def write_wav(samples, file_name):
+    with wave.open(file_name, "wb") as f:
+        f.setnchannels(1)
+        f.setsampwidth(2)
+        f.setframerate(SAMPLE_RATE)
+        f.writeframes((np.clip(samples, -1, 1) * 32767).astype(np.int16).tobytes())
+
+
+class StubWhisper:
+    """Stand-in for the whisperx pipeline, one segment of ten words every five seconds of audio."""
+
+    def transcribe(self, audio, batch_size=4, language="de"):
+        segments = []
+        for start in np.arange(0, len(audio) / SAMPLE_RATE - 1, 5.0):
+            text = " ".join(WORDS[(int(start) + i) % len(WORDS)] for i in range(10))
+            segments.append({"start": float(start), "end": float(start + 4.5), "text": text})
+        return {"segments": segments, "language": language}
+
+
+def stub_align(result1):
+    """Stand-in for whisperx.align, the words of a segment are spread evenly over it."""
+    segments = []
+    for segment in result1["segments"]:
+        words = segment["text"].split()
+        step = (segment["end"] - segment["start"]) / len(words)
+        segment = dict(segment)
+        segment["words"] = [
+            {
+                "word": word,
+                "start": segment["start"] + i * step,
+                "end": segment["start"] + (i + 1) * step,
+                "score": 1.0,
+            }
+            for i, word in enumerate(words)
+        ]
+        segments.append(segment)
+    return {"segments": segments, "word_segments": [word for segment in segments for word in segment["words"]]}
+
+
+class Turn:
+    def __init__(self, start, end):
+        self.start = start
+        self.end = end
+
+
+class StubDiarization:
+    """Stand-in for the pyannote pipeline, the speakers take turns every four seconds like the synthetic audio."""
+
+    def __init__(self, tracks):
+        self.tracks = tracks
+
+    def __call__(self, audio_data, num_speakers=None):
+        return self
+
+    def itertracks(self, yield_label=True):
+        seconds = self.duration
+        for i, start in enumerate(np.arange(0, seconds, 4.0)):
+            yield Turn(float(start), float(min(start + 4.0, seconds))), None, f"SPEAKER_{i % self.tracks:02d}"
+
+
+class Timer:
+    def __init__(self):
+        self.timings = {}
+
+    def __call__(self, name, func, *args, **kwargs):
+        start_time = time.perf_counter()
+        result = func(*args, **kwargs)
+        self.timings[name] = time.perf_counter() - start_time
+        return result
+
+
+def load_real_models(device):
+    import torch
+    import whisperx
+    from pyannote.audio import Pipeline
+
+    os.environ["HF_HUB_OFFLINE"] = "1"
+    compute_type = "float16" if device == "cuda" else "int8"
+    model = whisperx.load_model(
+        "large-v3", device, compute_type=compute_type, download_root=join(REPO, "models", "whisperx")
+    )
+    diarize_model = Pipeline.from_pretrained(
+        "pyannote/speaker-diarization", use_auth_token=os.getenv("HF_AUTH_TOKEN")
+    ).to(torch.device(device))
+    return model, diarize_model
+
+
+def run(args, root, models):
+    from src.util import probe, load_audio, isolate_voices
+    from src.transcription import transcribe_audio, align, diarize, clean_segments, MergedSegments
+    from src.srt import create_srt
+    from src.viewer import create_viewer
+    import main as gui
+
+    timer = Timer()
+    work_dir = tempfile.mkdtemp(dir=root)
+    user_dir = join(root, "data", "out", "benchmark")
+    os.makedirs(user_dir, exist_ok=True)
+
+    # Inputs: the mix of all speakers as one upload, and the tracks as a ZIP upload
+    tracks = synthetic_tracks(args.seconds, args.tracks, args.seed)
+    track_files = []
+    for index, samples in enumerate(tracks):
+        track_files.append(join(work_dir, f"track_{index}.wav"))
+        write_wav(samples, track_files[-1])
+    upload = join(work_dir, "upload.wav")
+    write_wav(np.sum(tracks, axis=0) / args.tracks, upload)
+    upload_zip = join(work_dir, "upload.zip")
+    with zipfile.ZipFile(upload_zip, "w") as zip_ref:
+        for file in track_files:
+            zip_ref.write(file, os.path.basename(file))
+
+    # Single file
+    timer("probe", probe, upload, sidecar=False)
+    timer("decode", load_audio, upload)
+    audio = timer("decode_memmap", load_audio, upload, audio_file=join(work_dir, "audio.f32"))
+    if models is None:
+        model, diarize_model = StubWhisper(), StubDiarization(args.tracks)
+        diarize_model.duration = len(audio) / SAMPLE_RATE
+        result1 = timer("asr", transcribe_audio, upload, audio, model, language="de")
+        result2 = timer("alignment", stub_align, result1)
+    else:
+        model, diarize_model = models
+        result1 = timer("asr", transcribe_audio, upload, audio, model, batch_size=args.batch_size, language="de")
+        result2 = timer("alignment", align, result1, audio, args.device)
+    result3 = timer("diarization", diarize, result2, audio, diarize_model, None)
+    data = timer("clean", clean_segments, result3, "de")
+
+    # ZIP file
+    zip_dir = join(work_dir, "zip")
+    start_time = time.perf_counter()
+    with zipfile.ZipFile(upload_zip, "r") as zip_ref:
+        zip_ref.extractall(zip_dir)
+    timer.timings["zip_extract"] = time.perf_counter() - start_time
+    timer("zip_probe", probe, upload_zip, sidecar=False)
+    zip_files = sorted(join(zip_dir, file) for file in os.listdir(zip_dir))
+    audio_files = [join(work_dir, f"isolated_{i}.f32") for i in range(len(zip_files))]
+    isolated = timer("isolate_voices", isolate_voices, zip_files, audio_files)
+    data_parts = []
+    start_time = time.perf_counter()
+    for index, track_audio in enumerate(isolated):
+        if models is None:
+            track_result = stub_align(model.transcribe(track_audio, language="de"))
+        else:
+            track_result = align(transcribe_audio(None, track_audio, model, language="de"), track_audio, args.device)
+        data_parts.append(clean_segments(diarize(track_result, track_audio, None, None, index), "de"))
+    timer.timings["zip_tracks"] = time.perf_counter() - start_time
+    merged = MergedSegments(data_parts)
+    timer("merge", lambda: sum(1 for _ in merged))
+
+    # Outputs
+    timer("create_srt", create_srt, merged)
+    file_name_out = join(user_dir, "upload.wav.mp4")
+    viewer = timer("create_viewer", create_viewer, data, file_name_out, True, False, REPO + "/", "de")
+    with open(join(user_dir, "upload.wav.html"), "w", encoding="utf-8") as f:
+        f.write(viewer)
+    shutil.copy(upload, file_name_out)
+    timer("prepare_download", gui.prepare_download, "upload.wav", "benchmark")
+
+    shutil.rmtree(work_dir, ignore_errors=True)
+    shutil.rmtree(user_dir, ignore_errors=True)
+    return timer.timings
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--seconds", type=float, default=600, help="length of the synthetic recording")
+    parser.add_argument("--tracks", type=int, default=3, help="number of speakers and tracks of the ZIP upload")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--real", action="store_true", help="use the real models, they must be cached locally")
+    parser.add_argument("--device", default="cuda")
+    parser.add_argument("--batch-size", type=int, default=4)
+    parser.add_argument("--output", help="write the results to this JSON file instead of printing them")
+    args = parser.parse_args()
+
+    # The modules read ROOT when they are imported, so it is set before the first import
+    root = tempfile.mkdtemp()
+    os.environ["ROOT"] = root
+    os.environ.setdefault("DEVICE", args.device)
+    models = load_real_models(args.device) if args.real else None
+
+    runs = [run(args, root, models) for _ in range(args.repeat)]
+    shutil.rmtree(root, ignore_errors=True)
+
+    commit = subprocess.run(["git", "rev-parse", "HEAD"], cwd=REPO, capture_output=True, text=True).stdout.strip()
+    results = {
+        "config": vars(args),
+        "environment": {
+            "commit": commit,
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "processor": platform.processor(),
+            "cpu_count": os.cpu_count(),
+            "numpy": np.__version__,
+        },
+        "stages": {
+            stage: {
+                "min": min(timings[stage] for timings in runs),
+                "mean": sum(timings[stage] for timings in runs) / len(runs),
+            }
+            for stage in runs[0]
+        },
+        "runs": runs,
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=4)
+    else:
+        print(json.dumps(results, indent=4))
+
+
+if __name__ == "__main__":
+    main()
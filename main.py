@@ -8,10 +8,12 @@ from os import listdir
 from os.path import isfile, join
 from functools import partial
 from dotenv import load_dotenv
-from nicegui import ui, events, app
+from nicegui import ui, events, app, run
+from fastapi.responses import PlainTextResponse
 
 from data.const import LANGUAGES, INVERTED_LANGUAGES
-from src.util import time_estimate
+from src.util import time_estimate, remove_probe
+from src import jobs, checkpoint, metrics, segments, summaries
 from src.help import (
     help as help_page,
 )  # Renamed to avoid conflict with built-in help function
@@ -27,6 +29,9 @@ WINDOWS = os.getenv("WINDOWS") == "True"
 SSL_CERTFILE = os.getenv("SSL_CERTFILE")
 SSL_KEYFILE = os.getenv("SSL_KEYFILE")
 SUMMARIZATION = os.getenv("SUMMARIZATION") == "True"
+# Serve the totals of the metrics log of the workers at /metrics in the Prometheus text format
+METRICS_ENDPOINT = os.getenv("METRICS_ENDPOINT", "True") == "True"
+METRICS_LOG = os.getenv("METRICS_LOG", join(ROOT, "data", "metrics.jsonl"))
 
 if WINDOWS:
     os.environ["PATH"] += os.pathsep + "ffmpeg/bin"
@@ -34,6 +39,20 @@ if WINDOWS:
 
 BACKSLASHCHAR = "\\"
 user_storage = {}
+# Totals of the metrics log, updated with the new lines on every request of /metrics
+metrics_reader = metrics.new_reader()
+
+
+def remaining_time(job):
+    """Estimated seconds left of a running job, or None if its transcription has not started yet."""
+    worker_user_dir = join(ROOT, "data", "worker", job["user_id"])
+    if not os.path.exists(worker_user_dir):
+        return None
+    for f in listdir(worker_user_dir):
+        parts = f.split("_")
+        if len(parts) >= 3 and "_".join(parts[2:]) == job["file_name"]:
+            return max(1, float(parts[0]) - (time.time() - float(parts[1])))
+    return None
 
 
 def read_files(user_id):
@@ -44,6 +63,14 @@ def read_files(user_id):
     error_path = join(ROOT, "data", "error", user_id)
 
     if os.path.exists(in_path):
+        # The queue in the order the workers will process it
+        conn = jobs.connect(ROOT)
+        try:
+            queued, running = jobs.schedule(conn)
+        finally:
+            conn.close()
+        user_jobs = {job["file_name"]: job for job in queued + running if job["user_id"] == user_id}
+
         for f in listdir(in_path):
             if isfile(join(in_path, f)) and f != "hotwords.txt" and f != "language.txt":
                 file_status = [
@@ -57,28 +84,31 @@ def read_files(user_id):
                     file_status[1] = "Datei transkribiert"
                     file_status[2] = 100.0
                     file_status[3] = 0
-                else:
-                    estimated_time, _ = time_estimate(join(in_path, f), ONLINE)
-                    if estimated_time == -1:
-                        estimated_time = 0
-                    file_status[3] = estimated_time
+                elif f in user_jobs:
+                    # Files are only probed on upload, see handle_upload(), until then they have no estimate
+                    file_status[3] = user_jobs[f]["estimate"]
 
                 user_storage[user_id]["file_list"].append(file_status)
 
-        files_in_queue = []
-        for u in user_storage:
-            for f in user_storage[u].get("file_list", []):
-                if (
-                    "updates" in user_storage[u]
-                    and len(user_storage[u]["updates"]) > 0
-                    and user_storage[u]["updates"][0] == f[0]
-                ):
-                    f = user_storage[u]["updates"]
-                if f[2] < 100.0:
-                    files_in_queue.append(f)
+        # Remaining time of the files being transcribed, then the files claimed by a worker that wait for
+        # the transcription, then the queued files in order. Every worker slot transcribes one file at a time.
+        time_ahead = 0
+        waiting = []
+        for job in running:
+            remaining = remaining_time(job)
+            if remaining is None:
+                waiting.append(job)
+            else:
+                time_ahead += remaining
+        parallel_jobs = max(1, len({job["worker"] for job in running}))
+        wait_times = {}
+        for job in waiting + queued:
+            if job["user_id"] == user_id:
+                wait_times[job["file_name"]] = time_ahead / parallel_jobs
+            time_ahead += job["estimate"]
 
         for file_status in user_storage[user_id]["file_list"]:
-            estimated_wait_time = sum(f[3] for f in files_in_queue if f[4] < file_status[4])
+            estimated_wait_time = wait_times.get(file_status[0], 0)
             if file_status[2] < 100.0:
                 wait_time_str = str(datetime.timedelta(seconds=round(estimated_wait_time + file_status[3])))
                 file_status[1] += wait_time_str
@@ -158,6 +188,22 @@ async def handle_upload(e: events.UploadEventArguments, user_id):
     with open(join(in_path, file_name), "wb") as f:
         f.write(e.content.read())
 
+    # Add the file to the worker queue. Probing a ZIP file extracts its tracks, so it runs outside the event loop.
+    estimated_time, duration = await run.io_bound(time_estimate, join(in_path, file_name), ONLINE)
+    conn = jobs.connect(ROOT)
+    try:
+        jobs.enqueue(
+            conn,
+            user_id,
+            file_name,
+            language or "de",
+            hotwords_content.splitlines(),
+            duration=max(duration, 0),
+            estimate=max(estimated_time, 0),
+        )
+    finally:
+        conn.close()
+
 
 def handle_reject(e: events.GenericEventArguments):
     ui.notify("Ungültige Datei. Es können nur Audio/Video-Dateien unter 12GB transkribiert werden.")
@@ -276,22 +322,32 @@ def delete_file(file_name, user_id, refresh_file_view):
         join(ROOT, "data", "error", user_id, file_name),
         join(ROOT, "data", "error", user_id, file_name + ".txt"),
     ]
-    suffixes = ["", ".txt", ".html", ".mp4", ".srt", ".htmlupdate", ".htmlfinal"]
+    suffixes = ["", ".txt", ".html", ".mp4", ".srt", ".htmlupdate", ".htmlfinal", ".profile", ".segments.jsonl"]
     for suffix in suffixes:
         paths_to_delete.append(join(ROOT, "data", "out", user_id, file_name + suffix))
 
     for path in paths_to_delete:
+        remove_probe(path)
         if os.path.exists(path):
             os.remove(path)
+    checkpoint.remove(ROOT, user_id, file_name)
+    shutil.rmtree(join(ROOT, "data", "out", user_id, file_name + ".prof"), ignore_errors=True)
+
+    conn = jobs.connect(ROOT)
+    try:
+        jobs.remove(conn, user_id, file_name)
+    finally:
+        conn.close()
 
     refresh_file_view(user_id=user_id, refresh_queue=True, refresh_results=True)
 
 
 def listen(user_id, refresh_file_view):
-    """Periodically check if a file is being transcribed and calculate its estimated progress."""
+    """Periodically check which files are being transcribed and calculate their estimated progress."""
     worker_user_dir = join(ROOT, "data", "worker", user_id)
 
     if os.path.exists(worker_user_dir):
+        updates = {}
         for f in listdir(worker_user_dir):
             if isfile(join(worker_user_dir, f)):
                 parts = f.split("_")
@@ -305,30 +361,22 @@ def listen(user_id, refresh_file_view):
 
                 in_file = join(ROOT, "data", "in", user_id, file_name)
                 if os.path.exists(in_file):
-                    user_storage[user_id]["updates"] = [
+                    updates[file_name] = [
                         file_name,
                         f"Datei wird transkribiert. Geschätzte Bearbeitungszeit: {datetime.timedelta(seconds=estimated_time_left)}",
                         progress * 100,
                         estimated_time_left,
                         os.path.getmtime(in_file),
                     ]
-                else:
+                elif os.path.exists(join(worker_user_dir, f)):
                     os.remove(join(worker_user_dir, f))
-                refresh_file_view(
-                    user_id=user_id,
-                    refresh_queue=True,
-                    refresh_results=(user_storage[user_id].get("file_in_progress") != file_name),
-                )
-                user_storage[user_id]["file_in_progress"] = file_name
-                return
-
-        # No files being processed
-        if user_storage[user_id].get("updates"):
-            user_storage[user_id]["updates"] = []
-            user_storage[user_id]["file_in_progress"] = None
-            refresh_file_view(user_id=user_id, refresh_queue=True, refresh_results=True)
-        else:
-            refresh_file_view(user_id=user_id, refresh_queue=True, refresh_results=False)
+
+        # Several workers can process files of the same user at the same time
+        files_in_progress = set(updates)
+        refresh_results = files_in_progress != user_storage[user_id]["files_in_progress"]
+        user_storage[user_id]["updates"] = updates
+        user_storage[user_id]["files_in_progress"] = files_in_progress
+        refresh_file_view(user_id=user_id, refresh_queue=True, refresh_results=refresh_results)
 
     out_user_dir = join(ROOT, "data", "out", user_id)
     if os.path.exists(out_user_dir):
@@ -351,6 +399,23 @@ def update_language(user_id):
         app.storage.user[f"{user_id}_language"] = INVERTED_LANGUAGES[user_storage[user_id]["language"].value]
 
 
+if METRICS_ENDPOINT:
+
+    @app.get("/metrics")
+    def metrics_endpoint():
+        """Queue length and totals of all jobs in the metrics log."""
+        with metrics_reader["lock"]:
+            for event in metrics.tail(METRICS_LOG, metrics_reader):
+                metrics.add(metrics_reader["totals"], event)
+            conn = jobs.connect(ROOT)
+            try:
+                queued, running = jobs.schedule(conn)
+            finally:
+                conn.close()
+            text = metrics.render(metrics_reader["totals"], len(queued), len(running))
+        return PlainTextResponse(text, media_type="text/plain; version=0.0.4")
+
+
 @ui.page("/editor")
 async def editor():
     """Prepare and open the editor for online editing."""
@@ -375,6 +440,8 @@ return content.slice({i * 500_000}, {(i + 1) * 500_000});
         update_file = full_file_name + "update"
         with open(update_file, "w", encoding="utf-8") as f:
             f.write(content.strip())
+        sidecar = segments.path(full_file_name[: -len(".html")])
+        segments.write(sidecar, segments.parse_editor(content, segments.read(sidecar)))
 
         ui.notify("Änderungen gespeichert.")
 
@@ -444,8 +511,7 @@ async def main_page():
     @ui.refreshable
     def display_queue(user_id):
         for file_status in sorted(user_storage[user_id]["file_list"], key=lambda x: (x[2], -x[4], x[0])):
-            if user_storage[user_id].get("updates") and user_storage[user_id]["updates"][0] == file_status[0]:
-                file_status = user_storage[user_id]["updates"]
+            file_status = user_storage[user_id].get("updates", {}).get(file_status[0], file_status)
             if 0 <= file_status[2] < 100.0:
                 ui.markdown(f"<b>{file_status[0].replace('_', BACKSLASHCHAR + '_')}:</b> {file_status[1]}")
                 ui.linear_progress(value=file_status[2] / 100, show_value=False, size="10px").props("instant-feedback")
@@ -462,6 +528,7 @@ async def main_page():
             join(ROOT + "data/out/" + user_id, file_name + ".htmlfinal"),
             join(ROOT + "data/out/" + user_id, file_name + ".todosummary"),
         )
+        summaries.request(ROOT, user_id, file_name)
 
         refresh_file_view(user_id, False, True)
 
@@ -469,8 +536,7 @@ async def main_page():
     def display_results(user_id):
         any_file_ready = False
         for file_status in sorted(user_storage[user_id]["file_list"], key=lambda x: (x[2], -x[4], x[0])):
-            if user_storage[user_id].get("updates") and user_storage[user_id]["updates"][0] == file_status[0]:
-                file_status = user_storage[user_id]["updates"]
+            file_status = user_storage[user_id].get("updates", {}).get(file_status[0], file_status)
             if file_status[2] >= 100.0:
                 ui.markdown(f"<b>{file_status[0].replace('_', BACKSLASHCHAR + '_')}</b>")
                 with ui.row():
@@ -570,7 +636,7 @@ async def main_page():
         "file_list": [],
         "content": "",
         "content_filename": "",
-        "file_in_progress": None,
+        "files_in_progress": set(),
         "known_errors": set(),
     }
 
@@ -0,0 +1,69 @@
+import os
+import json
+import hashlib
+import tempfile
+from os.path import join
+
+from src.checkpoint import to_json
+
+
+def key(tracks, language, hotwords, model_id):
+    """Hash of the decoded audio of all tracks and of everything else that changes the transcript."""
+    h = hashlib.sha256()
+    h.update(json.dumps([language, hotwords, model_id, len(tracks)]).encode("utf-8"))
+    for audio in tracks:
+        h.update(audio.data)
+    return h.hexdigest()
+
+
+def text_key(*parts):
+    """Hash of inputs that can be serialized as JSON, e.g. the text of a transcript for its summary."""
+    return hashlib.sha256(json.dumps(parts).encode("utf-8")).hexdigest()
+
+
+def load(root, cache_key):
+    """A cached entry, e.g. the segments of a transcript with one list per track, or None on a miss."""
+    path = join(root, "data", "cache", cache_key + ".json")
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+    # The modification time is the last use of the entry, see evict()
+    os.utime(path)
+    return data
+
+
+def save(root, cache_key, data, max_bytes):
+    cache_dir = join(root, "data", "cache")
+    os.makedirs(cache_dir, exist_ok=True)
+    # Several workers may write the same entry, each one writes its own temporary file
+    fd, tmp = tempfile.mkstemp(dir=cache_dir, suffix=".tmp")
+    with os.fdopen(fd, "w", encoding="utf-8") as f:
+        json.dump(data, f, default=to_json)
+    os.replace(tmp, join(cache_dir, cache_key + ".json"))
+    evict(root, max_bytes)
+
+
+def evict(root, max_bytes):
+    """Remove the least recently used entries until the cache is smaller than max_bytes."""
+    cache_dir = join(root, "data", "cache")
+    entries = []
+    for file in os.listdir(cache_dir):
+        if not file.endswith(".json"):
+            continue
+        try:
+            stat = os.stat(join(cache_dir, file))
+        except FileNotFoundError:
+            continue
+        entries.append((stat.st_mtime, stat.st_size, file))
+
+    total = sum(size for _, size, _ in entries)
+    for _, size, file in sorted(entries):
+        if total <= max_bytes:
+            break
+        try:
+            os.remove(join(cache_dir, file))
+        except FileNotFoundError:
+            pass
+        total -= size
@@ -0,0 +1,56 @@
+import os
+import json
+import shutil
+from os.path import isfile, join
+
+
+def to_json(value):
+    # numpy scalars and arrays in the results of the models
+    if hasattr(value, "tolist"):
+        return value.tolist()
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+def job_dir(root, user_id, file, source):
+    """Checkpoint directory of a job.
+
+    Checkpoints left behind by an earlier upload with the same name are discarded.
+    """
+    path = join(root, "data", "checkpoint", user_id, file)
+    stat = os.stat(source)
+    fingerprint = f"{stat.st_size} {stat.st_mtime}"
+    fingerprint_file = join(path, "source")
+    if isfile(fingerprint_file):
+        with open(fingerprint_file, "r") as f:
+            if f.read() != fingerprint:
+                shutil.rmtree(path, ignore_errors=True)
+    os.makedirs(path, exist_ok=True)
+    with open(fingerprint_file, "w") as f:
+        f.write(fingerprint)
+    return path
+
+
+def load(checkpoint_dir, stage):
+    """The saved result of a stage, or None if the stage has not run yet."""
+    if checkpoint_dir is None:
+        return None
+    path = join(checkpoint_dir, stage + ".json")
+    if not isfile(path):
+        return None
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def save(checkpoint_dir, stage, data):
+    if checkpoint_dir is None:
+        return
+    os.makedirs(checkpoint_dir, exist_ok=True)
+    path = join(checkpoint_dir, stage + ".json")
+    # Write to a temporary file first, so a crash never leaves a truncated checkpoint
+    with open(path + ".tmp", "w", encoding="utf-8") as f:
+        json.dump(data, f, default=to_json)
+    os.replace(path + ".tmp", path)
+
+
+def remove(root, user_id, file):
+    shutil.rmtree(join(root, "data", "checkpoint", user_id, file), ignore_errors=True)
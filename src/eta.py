@@ -0,0 +1,79 @@
+import os
+import json
+import time
+import tempfile
+import numpy as np
+from os.path import join
+
+from src import jobs
+
+# Stages that run after the progress file of a job is created, their sum is the processing time shown in the GUI
+STAGES = ["asr", "alignment", "diarization", "render"]
+# Minimum number of runs and maximum age in days of the history the estimates are learned from
+ETA_MIN_RUNS = int(os.getenv("ETA_MIN_RUNS", "5"))
+ETA_MAX_AGE = float(os.getenv("ETA_MAX_AGE", "30"))
+ETA_HISTORY = 200
+
+# Models read from data/eta.json, reloaded when the file changes
+models = {"mtime": None, "models": {}}
+
+
+def features(audio_seconds, tracks, per_track=True):
+    return [1.0, audio_seconds, tracks] if per_track else [1.0, audio_seconds]
+
+
+def fit(conn, root, device):
+    """Learn the processing time on a device from the latest runs and store the model in data/eta.json.
+
+    The processing time is modeled as a linear function of the length of all tracks and the number of tracks.
+    The number of tracks is only used if the history has runs with different numbers of tracks, otherwise it
+    cannot be told apart from the constant term. Without a full-rank fit, no model is stored.
+    """
+    rows = jobs.runs(conn, device, time.time() - ETA_MAX_AGE * 86400, ETA_HISTORY)
+    path = join(root, "data", "eta.json")
+    fitted = {}
+    if os.path.isfile(path):
+        with open(path, "r") as f:
+            fitted = json.load(f)
+
+    fitted.pop(device, None)
+    if len(rows) >= ETA_MIN_RUNS:
+        per_track = len({row["tracks"] for row in rows}) > 1
+        x = np.array([features(row["audio_seconds"], row["tracks"], per_track) for row in rows])
+        y = np.array([sum(row["timings"].get(stage, 0) for stage in STAGES) for row in rows])
+        coefficients, _, rank, _ = np.linalg.lstsq(x, y, rcond=None)
+        if rank == x.shape[1]:
+            fitted[device] = {
+                "coefficients": coefficients.tolist(),
+                "per_track": per_track,
+                "runs": len(rows),
+                "fitted": time.time(),
+            }
+
+    # Several worker slots may fit at the same time, each one writes its own temporary file
+    fd, tmp = tempfile.mkstemp(dir=join(root, "data"), suffix=".tmp")
+    with os.fdopen(fd, "w") as f:
+        json.dump(fitted, f, indent=4)
+    os.replace(tmp, path)
+
+
+def predict(root, device, audio_seconds, tracks):
+    """Learned processing time in seconds, or None if there is no recent model for the device."""
+    path = join(root, "data", "eta.json")
+    try:
+        mtime = os.path.getmtime(path)
+        if mtime != models["mtime"]:
+            with open(path, "r") as f:
+                models["models"] = json.load(f)
+            models["mtime"] = mtime
+    except (OSError, ValueError):
+        return None
+
+    model = models["models"].get(device)
+    if model is None or model["fitted"] < time.time() - ETA_MAX_AGE * 86400:
+        return None
+    # A model that does not grow with the length of the audio was fitted on too little variety
+    if model["coefficients"][1] <= 0:
+        return None
+    estimate = float(np.dot(model["coefficients"], features(audio_seconds, tracks, model.get("per_track", True))))
+    return estimate if estimate > 0 else None
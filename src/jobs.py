@@ -0,0 +1,327 @@
+import os
+import json
+import time
+import sqlite3
+import logging
+from os.path import isfile, isdir, join
+from dotenv import load_dotenv
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# Order in which queued jobs are processed: fifo, round_robin, fair or sjf, see order()
+SCHEDULER = os.getenv("SCHEDULER", "round_robin")
+# Users whose jobs are processed before the jobs of all other users
+PRIORITY_USERS = [u.strip() for u in os.getenv("PRIORITY_USERS", "").split(",") if u.strip()]
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+ERROR = "error"
+
+# Files in data/in/<user_id> that are settings, not uploads.
+IGNORED_FILES = ["hotwords.txt", "language.txt"]
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id TEXT NOT NULL,
+    file_name TEXT NOT NULL,
+    language TEXT NOT NULL DEFAULT 'de',
+    hotwords TEXT NOT NULL DEFAULT '',
+    state TEXT NOT NULL DEFAULT 'queued',
+    submitted REAL NOT NULL,
+    started REAL,
+    finished REAL,
+    worker TEXT,
+    lease_until REAL,
+    priority INTEGER NOT NULL DEFAULT 1,
+    duration REAL NOT NULL DEFAULT 0,
+    estimate REAL NOT NULL DEFAULT 0,
+    UNIQUE (user_id, file_name)
+);
+CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state, submitted);
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    job_id INTEGER,
+    worker TEXT,
+    device TEXT NOT NULL,
+    finished REAL NOT NULL,
+    duration REAL NOT NULL,
+    audio_seconds REAL NOT NULL,
+    tracks INTEGER NOT NULL,
+    timings TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS runs_device ON runs (device, finished);
+"""
+
+# Columns added after the first release of the index, added to existing databases on connect.
+MIGRATIONS = [
+    ("worker", "TEXT"),
+    ("lease_until", "REAL"),
+    ("priority", "INTEGER NOT NULL DEFAULT 1"),
+    ("duration", "REAL NOT NULL DEFAULT 0"),
+    ("estimate", "REAL NOT NULL DEFAULT 0"),
+]
+
+
+def connect(root):
+    """Open the job index in data/jobs.sqlite and create the schema if needed."""
+    os.makedirs(join(root, "data"), exist_ok=True)
+    conn = sqlite3.connect(
+        join(root, "data", "jobs.sqlite"),
+        timeout=30,
+        isolation_level=None,
+        check_same_thread=False,
+    )
+    conn.row_factory = sqlite3.Row
+    conn.executescript(SCHEMA)
+    columns = [row["name"] for row in conn.execute("PRAGMA table_info(jobs)")]
+    for column, definition in MIGRATIONS:
+        if column not in columns:
+            conn.execute(f"ALTER TABLE jobs ADD COLUMN {column} {definition}")
+    return conn
+
+
+def priority(user_id):
+    """Priority class of the jobs of a user, lower classes are processed first."""
+    return 0 if user_id in PRIORITY_USERS else 1
+
+
+def enqueue(conn, user_id, file_name, language="de", hotwords=[], submitted=None, duration=0, estimate=0):
+    """Add an upload to the queue. A re-upload with the same name is queued again.
+
+    duration is the length of the audio and estimate the expected processing time, both in seconds.
+    """
+    conn.execute(
+        """
+        INSERT INTO jobs (user_id, file_name, language, hotwords, state, submitted, priority, duration, estimate)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT (user_id, file_name) DO UPDATE SET
+            language = excluded.language,
+            hotwords = excluded.hotwords,
+            state = excluded.state,
+            submitted = excluded.submitted,
+            priority = excluded.priority,
+            duration = excluded.duration,
+            estimate = excluded.estimate,
+            started = NULL,
+            finished = NULL,
+            worker = NULL,
+            lease_until = NULL
+        """,
+        (
+            user_id,
+            file_name,
+            language,
+            "\n".join(hotwords),
+            QUEUED,
+            submitted or time.time(),
+            priority(user_id),
+            duration,
+            estimate,
+        ),
+    )
+
+
+def order(queued, running=[], policy=SCHEDULER):
+    """Sort queued jobs in the order they will be processed.
+
+    fifo: oldest upload first.
+    round_robin: the users take turns, a user with a running job has already had a turn.
+    fair: the user with the least audio queued or running before the job goes first.
+    sjf: shortest job first.
+    Jobs of a lower priority class always go first, ties are broken by upload time.
+    """
+    turns = {}
+    seconds = {}
+    for job in running:
+        turns[job["user_id"]] = turns.get(job["user_id"], 0) + 1
+        seconds[job["user_id"]] = seconds.get(job["user_id"], 0) + job["duration"]
+
+    keys = {}
+    for job in sorted(queued, key=lambda job: (job["submitted"], job["id"])):
+        user_id = job["user_id"]
+        if policy == "round_robin":
+            share = turns.get(user_id, 0)
+        elif policy == "fair":
+            share = seconds.get(user_id, 0)
+        elif policy == "sjf":
+            share = job["duration"]
+        else:
+            share = 0
+        keys[job["id"]] = (job["priority"], share, job["submitted"], job["id"])
+        turns[user_id] = turns.get(user_id, 0) + 1
+        seconds[user_id] = seconds.get(user_id, 0) + job["duration"]
+
+    return sorted(queued, key=lambda job: keys[job["id"]])
+
+
+def schedule(conn, policy=SCHEDULER):
+    """Queued and running jobs, the queued ones in the order they will be processed."""
+    queued = conn.execute("SELECT * FROM jobs WHERE state = ?", (QUEUED,)).fetchall()
+    running = conn.execute("SELECT * FROM jobs WHERE state = ?", (RUNNING,)).fetchall()
+    return order(queued, running, policy), running
+
+
+def claim(conn, worker_id, lease, policy=SCHEDULER):
+    """Lease the next job to a worker and return it, or None if the queue is empty.
+
+    Jobs of crashed workers, i.e. running jobs whose lease has expired, are claimed first.
+    Otherwise the next queued job is chosen by the scheduling policy, see order().
+    The lease must be renewed with heartbeat() while the job runs. Leases compare the clocks of the workers,
+    which must be synchronized, and the database relies on file locks, which do not work on NFS or SMB.
+    """
+    now = time.time()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        job = conn.execute(
+            """
+            SELECT * FROM jobs
+            WHERE state = ? AND (lease_until IS NULL OR lease_until < ?)
+            ORDER BY submitted, id LIMIT 1
+            """,
+            (RUNNING, now),
+        ).fetchone()
+        if job is None:
+            queued, running = schedule(conn, policy)
+            job = queued[0] if queued else None
+        if job is not None:
+            if job["state"] == RUNNING:
+                logger.warning(f"Reclaiming {job['file_name']} from worker {job['worker']}, lease expired")
+            conn.execute(
+                "UPDATE jobs SET state = ?, started = ?, worker = ?, lease_until = ? WHERE id = ?",
+                (RUNNING, now, worker_id, now + lease, job["id"]),
+            )
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+    return job
+
+
+def heartbeat(conn, worker_id, lease):
+    """Renew the leases of all jobs the worker is running."""
+    conn.execute(
+        "UPDATE jobs SET lease_until = ? WHERE worker = ? AND state = ?",
+        (time.time() + lease, worker_id, RUNNING),
+    )
+
+
+def release(conn, worker_id):
+    """Put the jobs of a worker back into the queue, e.g. when a worker with a fixed id restarts."""
+    conn.execute(
+        "UPDATE jobs SET state = ?, started = NULL, worker = NULL, lease_until = NULL WHERE worker = ? AND state = ?",
+        (QUEUED, worker_id, RUNNING),
+    )
+
+
+def finish(conn, job_id, worker_id, state=DONE):
+    """Mark a job as done or failed, unless its lease was lost to another worker in the meantime."""
+    conn.execute(
+        "UPDATE jobs SET state = ?, finished = ?, lease_until = NULL WHERE id = ? AND worker = ?",
+        (state, time.time(), job_id, worker_id),
+    )
+
+
+def record_run(conn, job_id, worker_id, device, duration, audio_seconds, tracks, timings):
+    """Store how long the stages of a finished job took, see src/eta.py.
+
+    duration is the length of the recording, audio_seconds the length of all its tracks together
+    and timings maps the name of every stage to its run time in seconds.
+    """
+    conn.execute(
+        """
+        INSERT INTO runs (job_id, worker, device, finished, duration, audio_seconds, tracks, timings)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        """,
+        (job_id, worker_id, device, time.time(), duration, audio_seconds, tracks, json.dumps(timings)),
+    )
+
+
+def runs(conn, device, since, limit):
+    """The latest runs on a device finished after since, newest first, with the timings decoded."""
+    rows = conn.execute(
+        "SELECT * FROM runs WHERE device = ? AND finished > ? ORDER BY finished DESC LIMIT ?",
+        (device, since, limit),
+    ).fetchall()
+    return [dict(row, timings=json.loads(row["timings"])) for row in rows]
+
+
+def remove(conn, user_id, file_name):
+    conn.execute("DELETE FROM jobs WHERE user_id = ? AND file_name = ?", (user_id, file_name))
+
+
+def common_languages(conn, count, history=100):
+    """The languages used most often by the last jobs, most common first."""
+    rows = conn.execute(
+        """
+        SELECT language FROM (SELECT language FROM jobs ORDER BY submitted DESC LIMIT ?)
+        GROUP BY language ORDER BY COUNT(*) DESC LIMIT ?
+        """,
+        (history, count),
+    ).fetchall()
+    return [row["language"] for row in rows]
+
+
+def read_settings(in_user_dir):
+    """Read the language and hotwords the GUI stored next to the uploads of a user."""
+    language = "de"
+    language_file = join(in_user_dir, "language.txt")
+    if isfile(language_file):
+        with open(language_file, "r") as f:
+            language = f.read().strip() or "de"
+
+    hotwords = []
+    hotwords_file = join(in_user_dir, "hotwords.txt")
+    if isfile(hotwords_file):
+        with open(hotwords_file, "r") as f:
+            hotwords = f.read().splitlines()
+    return language, hotwords
+
+
+def sync(conn, root, estimate=None):
+    """Enqueue uploads that are not in the index yet, e.g. from before the index existed.
+
+    estimate is an optional function returning the estimated processing time and the duration of a file.
+    This walks the whole input directory and is only meant to run once at worker startup.
+    """
+    in_dir = join(root, "data", "in")
+    if not isdir(in_dir):
+        return 0
+
+    known = set((row["user_id"], row["file_name"]) for row in conn.execute("SELECT user_id, file_name FROM jobs"))
+    added = 0
+    for user_id in os.listdir(in_dir):
+        in_user_dir = join(in_dir, user_id)
+        if not isdir(in_user_dir):
+            continue
+        language, hotwords = read_settings(in_user_dir)
+        for file_name in os.listdir(in_user_dir):
+            file_path = join(in_user_dir, file_name)
+            if file_name in IGNORED_FILES or not isfile(file_path) or (user_id, file_name) in known:
+                continue
+            if isfile(join(root, "data", "out", user_id, file_name + ".html")):
+                continue
+            estimated_time, duration = estimate(file_path) if estimate else (0, 0)
+            # Several workers may sync at the same time, never reset a job another worker already claimed.
+            added += conn.execute(
+                """
+                INSERT OR IGNORE INTO jobs
+                    (user_id, file_name, language, hotwords, state, submitted, priority, duration, estimate)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+                """,
+                (
+                    user_id,
+                    file_name,
+                    language,
+                    "\n".join(hotwords),
+                    QUEUED,
+                    os.path.getmtime(file_path),
+                    priority(user_id),
+                    max(duration, 0),
+                    max(estimated_time, 0),
+                ),
+            ).rowcount
+    return added
@@ -0,0 +1,196 @@
+import os
+import json
+import time
+import threading
+
+# Interval in seconds at which the resident memory is sampled while stages run
+SAMPLE_INTERVAL = 0.1
+
+# Peak memory of every running stage, updated by sample()
+active = {}
+active_lock = threading.Lock()
+sampler = {"thread": None}
+
+
+def current_rss():
+    """Resident memory of the process in bytes, 0 where it is not available."""
+    try:
+        with open("/proc/self/statm", "r") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return 0
+
+
+def sample():
+    while True:
+        time.sleep(SAMPLE_INTERVAL)
+        rss = current_rss()
+        with active_lock:
+            for token in active:
+                active[token] = max(active[token], rss)
+
+
+def usage_start():
+    with active_lock:
+        if sampler["thread"] is None:
+            sampler["thread"] = threading.Thread(target=sample, name="metrics", daemon=True)
+            sampler["thread"].start()
+        token = object()
+        active[token] = current_rss()
+    return token, time.time(), time.process_time()
+
+
+def usage_end(start):
+    """Wall time, CPU time and peak memory of a stage started with usage_start().
+
+    CPU time and memory are those of the whole process, so stages running at the same time in the pipeline
+    are counted in each other's values. The peak memory is sampled every SAMPLE_INTERVAL seconds.
+    """
+    token, wall, cpu = start
+    with active_lock:
+        peak = max(active.pop(token), current_rss())
+    return {
+        "seconds": time.time() - wall,
+        "cpu_seconds": time.process_time() - cpu,
+        "peak_rss_bytes": peak,
+    }
+
+
+def write(path, event):
+    """Append an event to the JSON-lines log, several workers may append to the same file."""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    line = json.dumps(event) + "\n"
+    with open(path, "a", encoding="utf-8") as f:
+        f.write(line)
+
+
+def new_reader():
+    """State of tail() and the totals of all events read so far."""
+    return {
+        "lock": threading.Lock(),
+        "inode": None,
+        "offset": 0,
+        "totals": {
+            "jobs": {},
+            "stages": {},
+            "errors": {},
+            "audio_seconds": 0.0,
+            "processing_seconds": 0.0,
+            "queue_wait_seconds": 0.0,
+            "queue_wait_count": 0,
+            "peak_rss_bytes": {},
+        },
+    }
+
+
+def tail(path, reader):
+    """Events appended to the log since the last call. A replaced log is read from the start."""
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return []
+    if stat.st_ino != reader["inode"] or stat.st_size < reader["offset"]:
+        reader["inode"] = stat.st_ino
+        reader["offset"] = 0
+
+    events = []
+    with open(path, "r", encoding="utf-8") as f:
+        f.seek(reader["offset"])
+        for line in f:
+            # A line that is still being written is read again next time
+            if not line.endswith("\n"):
+                break
+            reader["offset"] += len(line.encode("utf-8"))
+            try:
+                events.append(json.loads(line))
+            except ValueError:
+                continue
+    return events
+
+
+def add(totals, event):
+    key = (event["state"], event["cached"])
+    totals["jobs"][key] = totals["jobs"].get(key, 0) + 1
+    if event["state"] == "error":
+        stage = event.get("failed_stage") or "unknown"
+        totals["errors"][stage] = totals["errors"].get(stage, 0) + 1
+    else:
+        totals["audio_seconds"] += event["audio_seconds"]
+        totals["processing_seconds"] += event["processing_seconds"]
+    if event.get("queue_wait_seconds") is not None:
+        totals["queue_wait_seconds"] += event["queue_wait_seconds"]
+        totals["queue_wait_count"] += 1
+    for name, usage in event["stages"].items():
+        stage = totals["stages"].setdefault(name, {"count": 0, "seconds": 0.0, "cpu_seconds": 0.0})
+        stage["count"] += 1
+        stage["seconds"] += usage["seconds"]
+        stage["cpu_seconds"] += usage["cpu_seconds"]
+    totals["peak_rss_bytes"][event["worker"]] = max(
+        totals["peak_rss_bytes"].get(event["worker"], 0),
+        max([usage["peak_rss_bytes"] for usage in event["stages"].values()], default=0),
+    )
+
+
+def render(totals, queued, running):
+    """Totals in the Prometheus text format."""
+    lines = []
+
+    def metric(name, kind, help_text, samples):
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {kind}")
+        for labels, value in samples:
+            label_text = ",".join(f'{key}="{value}"' for key, value in labels.items())
+            lines.append(f"{name}{{{label_text}}} {value}" if label_text else f"{name} {value}")
+
+    metric(
+        "transcribo_queue_jobs",
+        "gauge",
+        "Jobs in the queue.",
+        [({"state": "queued"}, queued), ({"state": "running"}, running)],
+    )
+    metric(
+        "transcribo_jobs_total",
+        "counter",
+        "Finished jobs by result, cached jobs were served from the transcript cache.",
+        [({"state": state, "cached": str(cached).lower()}, count) for (state, cached), count in totals["jobs"].items()],
+    )
+    metric(
+        "transcribo_errors_total",
+        "counter",
+        "Failed jobs by the stage that failed.",
+        [({"stage": stage}, count) for stage, count in totals["errors"].items()],
+    )
+    metric(
+        "transcribo_audio_seconds_total", "counter", "Length of the transcribed audio.", [({}, totals["audio_seconds"])]
+    )
+    metric(
+        "transcribo_processing_seconds_total",
+        "counter",
+        "Processing time of the transcribed audio, divided by the audio seconds this is the real-time factor.",
+        [({}, totals["processing_seconds"])],
+    )
+    metric(
+        "transcribo_queue_wait_seconds",
+        "summary",
+        "Time between upload and start of the jobs.",
+        [],
+    )
+    lines.append(f"transcribo_queue_wait_seconds_sum {totals['queue_wait_seconds']}")
+    lines.append(f"transcribo_queue_wait_seconds_count {totals['queue_wait_count']}")
+    metric("transcribo_stage_seconds", "summary", "Wall time of the stages.", [])
+    for name, stage in totals["stages"].items():
+        lines.append(f'transcribo_stage_seconds_sum{{stage="{name}"}} {stage["seconds"]}')
+        lines.append(f'transcribo_stage_seconds_count{{stage="{name}"}} {stage["count"]}')
+    metric(
+        "transcribo_stage_cpu_seconds_total",
+        "counter",
+        "CPU time of the worker process while the stages ran.",
+        [({"stage": name}, stage["cpu_seconds"]) for name, stage in totals["stages"].items()],
+    )
+    metric(
+        "transcribo_worker_peak_rss_bytes",
+        "gauge",
+        "Peak resident memory of the workers.",
+        [({"worker": worker}, peak) for worker, peak in totals["peak_rss_bytes"].items()],
+    )
+    return "\n".join(lines) + "\n"
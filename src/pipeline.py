@@ -0,0 +1,64 @@
+import queue
+import logging
+import threading
+
+from src import metrics
+
+logger = logging.getLogger(__name__)
+
+
+def run_item(item, stages, on_error, on_done=None):
+    """Run all stages on one item in the calling thread. Returns None if a stage dropped the item.
+
+    on_done is called with the name of the stage, the item and the resource usage of the stage after every
+    stage that returned the item, see metrics.usage_end().
+    """
+    for name, func in stages:
+        start = metrics.usage_start()
+        try:
+            item = func(item)
+        except Exception as e:
+            logger.exception(f"Stage {name} failed")
+            try:
+                on_error(item)
+            except Exception as e:
+                logger.exception(f"Error handling of stage {name} failed")
+            return None
+        if item is None:
+            return None
+        if on_done is not None:
+            on_done(name, item, metrics.usage_end(start))
+    return item
+
+
+def run_stage(name, func, on_error, on_done, inbox, outbox):
+    while True:
+        item = inbox.get()
+        # The thread must survive every error, otherwise the stages before it block forever
+        try:
+            result = run_item(item, [(name, func)], on_error, on_done)
+            if result is not None and outbox is not None:
+                outbox.put(result)
+        except Exception as e:
+            logger.exception(f"Stage {name} failed")
+
+
+def start_pipeline(stages, on_error, maxsize=1, on_done=None):
+    """Start one thread per stage, connected by bounded queues, and return the queue of the first stage.
+
+    Every stage processes one item at a time in the order the items arrive, so items leave the
+    pipeline in the order they entered it. A stage drops an item by returning None, e.g. after it
+    reported an error. If a stage raises, on_error is called with the item and the item is dropped.
+    on_done is called after every stage, see run_item().
+    """
+    first = inbox = queue.Queue(maxsize)
+    for index, (name, func) in enumerate(stages):
+        outbox = queue.Queue(maxsize) if index + 1 < len(stages) else None
+        threading.Thread(
+            target=run_stage,
+            args=(name, func, on_error, on_done, inbox, outbox),
+            name=name,
+            daemon=True,
+        ).start()
+        inbox = outbox
+    return first
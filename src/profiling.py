@@ -0,0 +1,90 @@
+import os
+import cProfile
+import logging
+import threading
+import tracemalloc
+from os.path import join
+
+logger = logging.getLogger(__name__)
+
+# Number of allocation sites listed in the memory report of a stage
+TOP_ALLOCATIONS = 30
+
+# tracemalloc traces the whole process, it runs while at least one stage is profiled
+lock = threading.Lock()
+active = {"stages": 0}
+# Only one cProfile capture can run at a time, since Python 3.12 a second one raises
+cprofile_lock = threading.Lock()
+
+
+def profiled(name, func):
+    """Run a stage under cProfile and tracemalloc if the item has a profile_dir, otherwise call it directly.
+
+    Only one stage is captured with cProfile at a time. A stage that starts while another one is captured
+    only gets the memory report. Since Python 3.12 cProfile records all threads, so the profile includes
+    the other stages that run at the same time in the pipeline. The memory report lists the allocations
+    made while the stage ran that are still alive at its end, also those of other jobs. Errors of the
+    profiler are logged and never fail the job.
+    """
+
+    def run(item):
+        profile_dir = item.get("profile_dir")
+        if not profile_dir:
+            return func(item)
+
+        try:
+            os.makedirs(profile_dir, exist_ok=True)
+            with lock:
+                if active["stages"] == 0:
+                    tracemalloc.start()
+                active["stages"] += 1
+        except Exception as e:
+            logger.exception(f"Could not start profiling of stage {name}")
+            return func(item)
+
+        profiler = None
+        if cprofile_lock.acquire(blocking=False):
+            profiler = cProfile.Profile()
+            try:
+                profiler.enable()
+            except ValueError as e:
+                logger.error(f"Could not start cProfile for stage {name}. Error: {e}")
+                profiler = None
+                cprofile_lock.release()
+        try:
+            return func(item)
+        finally:
+            stop(name, profile_dir, profiler)
+
+    return run
+
+
+def stop(name, profile_dir, profiler):
+    """End the capture of a stage and write its reports."""
+    if profiler is not None:
+        try:
+            profiler.disable()
+            profiler.dump_stats(join(profile_dir, f"{name}.prof"))
+        except Exception as e:
+            logger.exception(f"Could not write profile of stage {name}")
+        finally:
+            cprofile_lock.release()
+    try:
+        with lock:
+            try:
+                snapshot = tracemalloc.take_snapshot()
+                current, peak = tracemalloc.get_traced_memory()
+            finally:
+                active["stages"] -= 1
+                if active["stages"] == 0:
+                    tracemalloc.stop()
+        write_memory_report(join(profile_dir, f"{name}.memory.txt"), snapshot, current, peak)
+    except Exception as e:
+        logger.exception(f"Could not write memory report of stage {name}")
+
+
+def write_memory_report(path, snapshot, current, peak):
+    with open(path, "w", encoding="utf-8") as f:
+        f.write(f"Traced memory at the end of the stage: {current / 1e6:.1f} MB, peak: {peak / 1e6:.1f} MB\n\n")
+        for stat in snapshot.statistics("lineno")[:TOP_ALLOCATIONS]:
+            f.write(f"{stat}\n")
@@ -0,0 +1,131 @@
+import os
+import json
+from html.parser import HTMLParser
+
+
+def path(file_name):
+    """Sidecar of a transcript, e.g. data/out/<user>/<file>.segments.jsonl for the editor <file>.html."""
+    return file_name + ".segments.jsonl"
+
+
+def records(data, speaker_names):
+    """Segments as stored in the sidecar, with the text and speaker names the editor shows."""
+    result = []
+    for segment in data:
+        record = {
+            "start": round(segment["start"], 3),
+            "end": round(segment["end"], 3),
+            "speaker": speaker_names[segment.get("speaker", "unknown")],
+            "text": segment["text"].strip().replace("ß", "ss"),
+        }
+        if "language" in segment:
+            record["language"] = segment["language"]
+        result.append(record)
+    return result
+
+
+def write(sidecar, segments):
+    with open(sidecar + ".tmp", "w", encoding="utf-8") as f:
+        for segment in segments:
+            f.write(json.dumps(segment, ensure_ascii=False) + "\n")
+    os.replace(sidecar + ".tmp", sidecar)
+
+
+def read(sidecar):
+    """The segments of a sidecar, or None if there is none."""
+    try:
+        with open(sidecar, "r", encoding="utf-8") as f:
+            return [json.loads(line) for line in f if line.strip()]
+    except FileNotFoundError:
+        return None
+
+
+def transcript_text(segments):
+    """One "speaker: text" line per segment, the input of the summary."""
+    return "".join(f"{segment['speaker']}: {segment['text']}\n" for segment in segments)
+
+
+def parse_time(text):
+    """Seconds of a datetime.timedelta string like "1:02:03" or "1 day, 0:00:02"."""
+    days = 0
+    if "day" in text:
+        day_text, text = text.split(", ")
+        days = int(day_text.split()[0])
+    hours, minutes, seconds = text.strip().split(":")
+    return days * 86400 + int(hours) * 3600 + int(minutes) * 60 + float(seconds)
+
+
+class EditorParser(HTMLParser):
+    """Collects the segments of the editor HTML in a single pass.
+
+    A segment is a span with class "segment", its speaker is the selected option of the last select before it.
+    """
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.segments = []
+        self.speaker = ""
+        self.option = None
+        self.segment = None
+        self.depth = 0
+
+    def handle_starttag(self, tag, attrs):
+        attrs = dict(attrs)
+        if self.segment is not None:
+            if tag == "span":
+                self.depth += 1
+            return
+        if tag == "option":
+            self.option = "" if "selected" in attrs else None
+        elif tag == "span" and attrs.get("class") == "segment":
+            start, _, end = (attrs.get("title") or "").partition(" - ")
+            try:
+                start, end = parse_time(start), parse_time(end)
+            except ValueError:
+                start = end = None
+            self.segment = {"id": attrs.get("id"), "start": start, "end": end, "speaker": self.speaker, "text": ""}
+            self.depth = 0
+
+    def handle_endtag(self, tag):
+        if self.segment is not None:
+            if tag != "span":
+                return
+            if self.depth > 0:
+                self.depth -= 1
+                return
+            self.segment["text"] = " ".join(self.segment["text"].split())
+            self.segments.append(self.segment)
+            self.segment = None
+        elif tag == "option" and self.option is not None:
+            self.speaker = self.option.strip()
+            self.option = None
+
+    def handle_data(self, data):
+        if self.segment is not None:
+            self.segment["text"] += data
+        elif self.option is not None:
+            self.option += data
+
+
+def parse_editor(html, previous=None):
+    """Segments of the editor HTML.
+
+    The editor only shows times rounded to seconds. Segments that still have the id and the rounded times
+    of a segment of the previous sidecar keep its exact times and language.
+    """
+    parser = EditorParser()
+    parser.feed(html)
+    parser.close()
+
+    previous = previous or []
+    result = []
+    for segment in parser.segments:
+        index = segment.pop("id")
+        if index is not None and index.isdigit() and int(index) < len(previous):
+            old = previous[int(index)]
+            if (round(old["start"]), round(old["end"])) == (segment["start"], segment["end"]):
+                segment["start"], segment["end"] = old["start"], old["end"]
+                if "language" in old:
+                    segment["language"] = old["language"]
+        result.append(segment)
+    return result
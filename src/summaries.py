@@ -0,0 +1,84 @@
+import os
+import time
+from os.path import isdir, join
+
+
+def request_file(root, user_id, file_name):
+    return join(root, "data", "summary", "requests", user_id, file_name)
+
+
+def claim_file(root, user_id, file_name):
+    return join(root, "data", "summary", "claims", user_id, file_name)
+
+
+def request(root, user_id, file_name):
+    """Queue the summary of data/out/<user>/<file>.todosummary for the summarizers."""
+    path = request_file(root, user_id, file_name)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w") as f:
+        f.write("")
+
+
+def sync(root):
+    """Queue the .todosummary files that have no request yet, e.g. from before the requests were introduced.
+
+    Returns the number of queued summaries.
+    """
+    out_dir = join(root, "data", "out")
+    if not isdir(out_dir):
+        return 0
+    count = 0
+    for user_id in os.listdir(out_dir):
+        if not isdir(join(out_dir, user_id)):
+            continue
+        for f in os.listdir(join(out_dir, user_id)):
+            if f.endswith(".todosummary"):
+                file_name = f[: -len(".todosummary")]
+                if not os.path.exists(request_file(root, user_id, file_name)):
+                    request(root, user_id, file_name)
+                    count += 1
+    return count
+
+
+def claim(root, worker_id, lease):
+    """Claim the oldest request that no other summarizer works on.
+
+    Returns user id, file name and the claim, or None. A claim is a file in data/summary/claims, it expires
+    like the lease of a job if the summarizer that holds it stops renewing its modification time.
+    """
+    requests_dir = join(root, "data", "summary", "requests")
+    if not isdir(requests_dir):
+        return None
+    requests = []
+    for user_id in os.listdir(requests_dir):
+        for file_name in os.listdir(join(requests_dir, user_id)):
+            try:
+                requests.append((os.path.getmtime(join(requests_dir, user_id, file_name)), user_id, file_name))
+            except FileNotFoundError:
+                continue
+
+    for _, user_id, file_name in sorted(requests):
+        path = claim_file(root, user_id, file_name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        try:
+            if time.time() - os.path.getmtime(path) > lease:
+                os.remove(path)
+        except FileNotFoundError:
+            pass
+        try:
+            fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            continue
+        os.write(fd, worker_id.encode("utf-8"))
+        os.close(fd)
+        return user_id, file_name, path
+    return None
+
+
+def release(root, user_id, file_name, path):
+    """Remove a handled request and its claim."""
+    for f in [request_file(root, user_id, file_name), path]:
+        try:
+            os.remove(f)
+        except FileNotFoundError:
+            pass
@@ -1,13 +1,26 @@
 import os
 import torch
+import numpy as np
 import pandas as pd
 import time
+import heapq
+import threading
 import whisperx
+from collections import OrderedDict
 from whisperx.audio import SAMPLE_RATE, log_mel_spectrogram, N_SAMPLES
 
 from data.const import data_leaks
+from src import checkpoint
+from src.util import load_audio
 
 DEVICE = os.getenv("DEVICE")
+# Number of alignment models kept in memory between files, and their maximum total size in MB
+ALIGN_CACHE_SIZE = int(os.getenv("ALIGN_CACHE_SIZE", "3"))
+ALIGN_CACHE_MEMORY = int(os.getenv("ALIGN_CACHE_MEMORY", "4000"))
+
+# (language, device) -> (model, metadata, size in bytes), least recently used first
+align_models = OrderedDict()
+align_lock = threading.Lock()
 
 
 def get_prompt(self, tokenizer, previous_tokens, without_timestamps, prefix):
@@ -32,35 +45,101 @@ def get_prompt(self, tokenizer, previous_tokens, without_timestamps, prefix):
 
 
 def detect_language(audio, model):
+    return detect_languages([audio], model)[0]
+
+
+def detect_languages(windows, model, batch_size=4):
+    """Language and probability of every audio window, batch_size windows per pass through the encoder."""
     model_n_mels = model.model.feat_kwargs.get("feature_size")
-    segment = log_mel_spectrogram(
-        audio[:N_SAMPLES],
-        n_mels=model_n_mels if model_n_mels is not None else 80,
-        padding=0 if audio.shape[0] >= N_SAMPLES else N_SAMPLES - audio.shape[0],
+    results = []
+    for i in range(0, len(windows), batch_size):
+        # Every window is cut or padded to 30 seconds, so the mel spectrograms can be stacked
+        mels = [
+            log_mel_spectrogram(
+                window[:N_SAMPLES],
+                n_mels=model_n_mels if model_n_mels is not None else 80,
+                padding=0 if window.shape[0] >= N_SAMPLES else N_SAMPLES - window.shape[0],
+            )
+            for window in windows[i : i + batch_size]
+        ]
+        encoder_output = model.model.encode(torch.stack(mels).cpu().numpy())
+        for languages in model.model.model.detect_language(encoder_output):
+            language_token, language_probability = languages[0]
+            results.append((language_token[2:-2], language_probability))
+    return results
+
+
+def autotune_batch_size(model, language="de", batch_sizes=(1, 2, 4, 8, 16, 32, 64)):
+    """Batch size with the highest Whisper throughput on this machine.
+
+    The batch sizes are timed in increasing order on a synthetic 30 second clip. The search stops at the
+    first out-of-memory error, or as soon as a larger batch is not faster anymore.
+    """
+    from faster_whisper.tokenizer import Tokenizer
+
+    t = np.arange(N_SAMPLES) / SAMPLE_RATE
+    noise = np.random.default_rng(0).standard_normal(N_SAMPLES)
+    clip = (0.1 * np.sin(2 * np.pi * 220 * t) * (np.sin(2 * np.pi * 3 * t) > 0) + 0.01 * noise).astype(np.float32)
+    model_n_mels = model.model.feat_kwargs.get("feature_size")
+    mel = log_mel_spectrogram(clip, n_mels=model_n_mels if model_n_mels is not None else 80).cpu().numpy()
+    tokenizer = Tokenizer(
+        model.model.hf_tokenizer, model.model.model.is_multilingual, task="transcribe", language=language
     )
-    encoder_output = model.model.encode(segment)
-    results = model.model.model.detect_language(encoder_output)
-    language_token, language_probability = results[0][0]
-    language = language_token[2:-2]
-    return (language, language_probability)
 
+    # The first call initializes the model and is not timed
+    model.model.generate_segment_batched(mel[None], tokenizer, model.options)
+    best_batch_size, best_throughput = batch_sizes[0], 0
+    for batch_size in batch_sizes:
+        features = np.repeat(mel[None], batch_size, axis=0)
+        try:
+            start_time = time.time()
+            model.model.generate_segment_batched(features, tokenizer, model.options)
+            throughput = batch_size / (time.time() - start_time)
+        except RuntimeError as e:
+            if "out of memory" not in str(e).lower():
+                raise
+            print(f"Batch size {batch_size} ran out of memory.")
+            break
+        print(f"Batch size {batch_size}: {throughput:.2f} clips per second.")
+        if throughput <= best_throughput:
+            break
+        best_batch_size, best_throughput = batch_size, throughput
 
-def transcribe(
-    complete_name,
-    model,
-    diarize_model,
-    device,
-    num_speaker,
-    add_language=False,
-    hotwords=[],
-    batch_size=4,
-    multi_mode_track=None,
-    language="de",
-):
     torch.cuda.empty_cache()
+    return best_batch_size
 
-    # Convert audio given a file path.
-    audio = whisperx.load_audio(complete_name)
+
+def load_align_model(language, device):
+    """Alignment model for a language, from the cache if it was used recently."""
+    key = (language, device)
+    with align_lock:
+        if key in align_models:
+            align_models.move_to_end(key)
+            model_a, metadata, _ = align_models[key]
+            return model_a, metadata
+
+    start_time = time.time()
+    model_a, metadata = whisperx.load_align_model(language_code=language, device=device)
+    size = sum(p.numel() * p.element_size() for p in model_a.parameters())
+    print(f"Loading alignment model for {language} took {time.time() - start_time:.2f} seconds.")
+
+    with align_lock:
+        align_models[key] = (model_a, metadata, size)
+        # The model that was just loaded is only evicted if the cache is disabled
+        while len(align_models) > ALIGN_CACHE_SIZE or (
+            len(align_models) > 1
+            and sum(entry[2] for entry in align_models.values()) > ALIGN_CACHE_MEMORY * 1024 * 1024
+        ):
+            align_models.popitem(last=False)
+    return model_a, metadata
+
+
+def transcribe_audio(complete_name, audio, model, hotwords=[], batch_size=4, language="de", checkpoint_dir=None):
+    """Speech recognition, returns the raw Whisper segments and the language."""
+    result1 = checkpoint.load(checkpoint_dir, "asr")
+    if result1 is not None:
+        print("Transcription restored from checkpoint.")
+        return result1
 
     start_time = time.time()
 
@@ -73,7 +152,7 @@ def transcribe(
         decode_options = {"language": None, "prefix": " ".join(hotwords)}
 
         result1 = mlx_whisper.transcribe(
-            complete_name,
+            audio,
             path_or_hf_repo="mlx-community/whisper-large-v3-mlx",
             **decode_options,
         )
@@ -83,9 +162,18 @@ def transcribe(
     print(f"Transcription took {time.time() - start_time:.2f} seconds.")
     if len(hotwords) > 0:
         model.options = model.options._replace(prefix=None)
+    checkpoint.save(checkpoint_dir, "asr", result1)
+    return result1
+
 
-    # Align whisper output.
-    model_a, metadata = whisperx.load_align_model(language_code=result1["language"], device=device)
+def align(result1, audio, device, checkpoint_dir=None):
+    """Word-level alignment of the segments."""
+    result2 = checkpoint.load(checkpoint_dir, "alignment")
+    if result2 is not None:
+        print("Alignment restored from checkpoint.")
+        return result2
+
+    model_a, metadata = load_align_model(result1["language"], device)
     start_aligning = time.time()
 
     print("Aligning...")
@@ -99,56 +187,92 @@ def transcribe(
     )
 
     print(f"Alignment took {time.time() - start_aligning:.2f} seconds.")
+    checkpoint.save(checkpoint_dir, "alignment", result2)
+    return result2
 
-    if add_language:
+
+def add_languages(result2, audio, model, hotwords=[], language="de", batch_size=4, checkpoint_dir=None):
+    """Detect the language of every segment, segments below 85% confidence get the default language."""
+    languages = checkpoint.load(checkpoint_dir, "language")
+    if languages is None:
         start_language = time.time()
         print("Adding language...")
+        # The segment with half a second of context on both sides, only the first 30 seconds are used
+        windows = []
         for segment in result2["segments"]:
-            start = (int(segment["start"]) * 16_000) - 8_000
-            end = ((int(segment["end"]) + 1) * 16_000) + 8_000
-            segment_audio = audio[start:end]
-            if DEVICE == "mps":
+            start = max((int(segment["start"]) * 16_000) - 8_000, 0)
+            end = min(((int(segment["end"]) + 1) * 16_000) + 8_000, start + N_SAMPLES)
+            windows.append((start, end))
+
+        if DEVICE == "mps":
+            import mlx_whisper
+
+            languages = []
+            for start, end in windows:
                 ## This is a workaround to use the whisper model in mps, it doesn't have "detect language" method
                 decode_options = {"language": None, "prefix": " ".join(hotwords)}
-                language = mlx_whisper.transcribe(
-                    segment_audio, path_or_hf_repo="mlx-community/whisper-large-v3-mlx", **decode_options
+                detected = mlx_whisper.transcribe(
+                    audio[start:end], path_or_hf_repo="mlx-community/whisper-large-v3-mlx", **decode_options
+                )
+                languages.append(detected["language"])
+        else:
+            # Short segments within the same seconds share a window, every window is only encoded once
+            unique_windows = list(dict.fromkeys(windows))
+            detected = dict(
+                zip(
+                    unique_windows,
+                    detect_languages([audio[start:end] for start, end in unique_windows], model, batch_size),
                 )
-                segment["language"] = language["language"]
-            else:
-                detected_language, language_probability = detect_language(segment_audio, model)
-                segment["language"] = detected_language if language_probability > 0.85 else language
+            )
+            languages = [
+                detected_language if language_probability > 0.85 else language
+                for detected_language, language_probability in (detected[window] for window in windows)
+            ]
         print(f"Adding language took {time.time() - start_language:.2f} seconds.")
+        checkpoint.save(checkpoint_dir, "language", languages)
 
-    # Diarize and assign speaker labels.
-    start_diarize = time.time()
-    print("Diarizing...")
-    audio_data = {
-        "waveform": torch.from_numpy(audio[None, :]),
-        "sample_rate": SAMPLE_RATE,
-    }
+    for segment, segment_language in zip(result2["segments"], languages):
+        segment["language"] = segment_language
+    return result2
 
+
+def diarize(result2, audio, diarize_model, num_speaker, multi_mode_track=None, checkpoint_dir=None):
+    """Assign speaker labels, or the label of the track in multi-track mode."""
     if multi_mode_track is None:
-        segments = diarize_model(audio_data, num_speakers=num_speaker)
+        turns = checkpoint.load(checkpoint_dir, "diarization")
+        if turns is None:
+            start_diarize = time.time()
+            print("Diarizing...")
+            audio_data = {
+                "waveform": torch.from_numpy(audio[None, :]),
+                "sample_rate": SAMPLE_RATE,
+            }
+            segments = diarize_model(audio_data, num_speakers=num_speaker)
+            turns = [[turn.start, turn.end, speaker] for turn, _, speaker in segments.itertracks(yield_label=True)]
+            print(f"Diarization took {time.time() - start_diarize:.2f} seconds.")
+            checkpoint.save(checkpoint_dir, "diarization", turns)
+        else:
+            print("Diarization restored from checkpoint.")
 
-        diarize_df = pd.DataFrame(segments.itertracks(yield_label=True), columns=["segment", "label", "speaker"])
-        diarize_df["start"] = diarize_df["segment"].apply(lambda x: x.start)
-        diarize_df["end"] = diarize_df["segment"].apply(lambda x: x.end)
+        diarize_df = pd.DataFrame(turns, columns=["start", "end", "speaker"])
         result3 = whisperx.assign_word_speakers(diarize_df, result2)
     else:
         for segment in result2["segments"]:
             segment["speaker"] = "SPEAKER_" + str(multi_mode_track).zfill(2)
         result3 = result2
 
-    print(f"Diarization took {time.time() - start_diarize:.2f} seconds.")
-    print(f"Total time: {time.time() - start_time:.2f} seconds.")
     torch.cuda.empty_cache()
     if DEVICE == "mps":
         torch.mps.empty_cache()
-    # Text cleanup.
+    return result3
+
+
+def clean_segments(result3, language):
+    """Remove known hallucinations of Whisper and empty segments."""
     cleaned_segments = []
     for segment in result3["segments"]:
-        if result1["language"] in data_leaks:
-            for line in data_leaks[result1["language"]]:
+        if language in data_leaks:
+            for line in data_leaks[language]:
                 if line in segment["text"]:
                     segment["text"] = segment["text"].replace(line, "")
         segment["text"] = segment["text"].strip()
@@ -157,3 +281,48 @@ def transcribe(
             cleaned_segments.append(segment)
 
     return cleaned_segments
+
+
+class MergedSegments:
+    """Segments of several tracks in the order of their start times.
+
+    The tracks are merged lazily on every iteration, so the merged list is never built.
+    """
+
+    def __init__(self, parts):
+        self.parts = parts
+
+    def __iter__(self):
+        return heapq.merge(*self.parts, key=lambda segment: segment["start"])
+
+
+def transcribe(
+    complete_name,
+    model,
+    diarize_model,
+    device,
+    num_speaker,
+    add_language=False,
+    hotwords=[],
+    batch_size=4,
+    multi_mode_track=None,
+    language="de",
+    audio=None,
+    checkpoint_dir=None,
+):
+    torch.cuda.empty_cache()
+
+    # Convert audio given a file path.
+    if audio is None:
+        audio = load_audio(complete_name)
+
+    start_time = time.time()
+    result1 = transcribe_audio(complete_name, audio, model, hotwords, batch_size, language, checkpoint_dir)
+    result2 = align(result1, audio, device, checkpoint_dir)
+    if add_language:
+        result2 = add_languages(result2, audio, model, hotwords, language, batch_size, checkpoint_dir)
+    result3 = diarize(result2, audio, diarize_model, num_speaker, multi_mode_track, checkpoint_dir)
+    print(f"Total time: {time.time() - start_time:.2f} seconds.")
+
+    # Text cleanup.
+    return clean_segments(result3, result1["language"])
@@ -1,70 +1,237 @@
-from pydub import AudioSegment
+import numpy as np
 import subprocess
+import tempfile
+import hashlib
+import json
 import os
+import zipfile
+from os.path import abspath, join
+from dotenv import load_dotenv
+
+from src import eta
+
+load_dotenv()
 
 DEVICE = os.getenv("DEVICE")
-      
-
-def isolate_voices(file_paths):
-    for index in range(len(file_paths)):
-        chunk_length_ms = 100
-        chunked = []
-        for file in file_paths:
-            audio = AudioSegment.from_file(file)
-            chunked.append([audio[i : i + chunk_length_ms] for i in range(0, len(audio), chunk_length_ms)])
-
-        processed_chunks = [
-            filter_nondominant_voice([chunks[i] for chunks in chunked], index) for i in range(len(chunked[0]))
-        ]
+ROOT = os.getenv("ROOT")
+SAMPLE_RATE = 16000
+
+
+def isolate_voices(file_paths, audio_files, chunk_length=0.1, crossfade=0.01, sr=SAMPLE_RATE):
+    """Silence every track wherever another track is louder, so each voice is only transcribed from its own track.
 
-        processed_audio = sum(processed_chunks)
-        processed_audio.export(file_paths[index])
+    Every track is decoded once to audio_files, see decode_to_file, and compared in chunks of chunk_length
+    seconds. The tracks are written back to file_paths and returned memory-mapped like load_audio.
+    """
+    tracks = []
+    for file, audio_file in zip(file_paths, audio_files):
+        decode_to_file(file, audio_file, sr=sr)
+        tracks.append(open_audio(audio_file, mode="r+"))
+    chunk = int(chunk_length * sr)
+    n_chunks = -(-max(len(track) for track in tracks) // chunk)
+    # Tracks are processed in blocks of one minute, so the memory used does not depend on their length
+    block = 600 * chunk
 
+    # RMS of every chunk of every track, shorter tracks are padded with silence
+    rms = np.zeros((len(tracks), n_chunks), dtype=np.float32)
+    for index, track in enumerate(tracks):
+        for start in range(0, len(track), block):
+            part = track[start : start + block]
+            n = -(-len(part) // chunk)
+            padded = np.zeros(n * chunk, dtype=np.float32)
+            padded[: len(part)] = part
+            rms[index, start // chunk : start // chunk + n] = np.sqrt(
+                np.mean(np.square(padded.reshape(n, chunk)), axis=1)
+            )
+    gains = (rms >= rms.max(axis=0)).astype(np.float32)
 
-def filter_nondominant_voice(segments, index):
-    value = segments[index].dBFS
-    for i, segment in enumerate(segments):
-        if i == index:
+    # The gain is constant within a chunk and ramps linearly over crossfade seconds around chunk boundaries
+    fade = min(int(crossfade * sr), chunk - 1)
+    xp = (np.arange(n_chunks)[:, None] * chunk + np.array([fade / 2, chunk - fade / 2])).ravel()
+
+    for index, (file, track) in enumerate(zip(file_paths, tracks)):
+        # An empty track is no memory map and has nothing to write back
+        if not isinstance(track, np.memmap):
             continue
-        if segment.dBFS > value:
-            return segment - 100
-    return segments[index]
-
-
-def get_length(filename):
-    result = subprocess.run(
-        [
-            "ffprobe",
-            "-v",
-            "error",
-            "-show_entries",
-            "format=duration",
-            "-of",
-            "default=noprint_wrappers=1:nokey=1",
-            filename,
-        ],
-        stdout=subprocess.PIPE,
-        stderr=subprocess.STDOUT,
-    )
-    return float(result.stdout)
-
-
-def time_estimate(filename, online=True):
+        fp = np.repeat(gains[index], 2)
+        # Written as FLAC, whatever the extension of the file
+        cmd = ["ffmpeg", "-nostdin", "-y", "-f", "s16le", "-ac", "1", "-ar", str(sr), "-i", "-", "-f", "flac", file]
+        process = subprocess.Popen(cmd, stdin=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        for start in range(0, len(track), block):
+            end = min(start + block, len(track))
+            track[start:end] *= np.interp(np.arange(start, end), xp, fp)
+            process.stdin.write((np.clip(track[start:end], -1, 1) * 32767).astype(np.int16).tobytes())
+        process.stdin.close()
+        if process.wait() != 0:
+            raise subprocess.CalledProcessError(process.returncode, cmd)
+        track.flush()
+    return [open_audio(audio_file) for audio_file in audio_files]
+
+
+def ffmpeg_decode_cmd(filename, audio_filter=None, sr=SAMPLE_RATE):
+    cmd = ["ffmpeg", "-nostdin", "-threads", "0", "-i", filename]
+    if audio_filter:
+        cmd += ["-af", audio_filter]
+    return cmd + ["-f", "s16le", "-ac", "1", "-acodec", "pcm_s16le", "-ar", str(sr), "-"]
+
+
+def decode_to_file(filename, audio_file, audio_filter=None, sr=SAMPLE_RATE):
+    """Decode a file to raw mono float32 samples in audio_file, one minute at a time."""
+    os.makedirs(os.path.dirname(audio_file), exist_ok=True)
+    cmd = ffmpeg_decode_cmd(filename, audio_filter, sr)
+    process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    with open(audio_file + ".tmp", "wb") as f:
+        while True:
+            pcm = process.stdout.read(2 * 60 * sr)
+            if not pcm:
+                break
+            f.write((np.frombuffer(pcm, np.int16).astype(np.float32) / 32768.0).tobytes())
+    if process.wait() != 0:
+        raise subprocess.CalledProcessError(process.returncode, cmd)
+    os.replace(audio_file + ".tmp", audio_file)
+
+
+def open_audio(audio_file, mode="c"):
+    """Memory-map the samples written by decode_to_file.
+
+    Only the pages a stage actually reads are loaded. With mode "c", changes stay in memory and the file is
+    never modified.
+    """
+    if os.path.getsize(audio_file) == 0:
+        return np.zeros(0, dtype=np.float32)
+    return np.memmap(audio_file, dtype=np.float32, mode=mode)
+
+
+def load_audio(filename, audio_filter=None, sr=SAMPLE_RATE, audio_file=None):
+    """Decode a file to mono float32 samples like whisperx.load_audio, optionally applying an ffmpeg audio filter.
+
+    With audio_file, the samples are decoded to that file, unless it exists already, and memory-mapped.
+    """
+    if audio_file is not None:
+        if not os.path.isfile(audio_file):
+            decode_to_file(filename, audio_file, audio_filter, sr)
+        return open_audio(audio_file)
+    out = subprocess.run(ffmpeg_decode_cmd(filename, audio_filter, sr), capture_output=True, check=True).stdout
+    return np.frombuffer(out, np.int16).flatten().astype(np.float32) / 32768.0
+
+
+def probe_file(filename):
+    """Sidecar file with the probe result of a media file in data/probe."""
+    return join(ROOT, "data", "probe", hashlib.sha1(abspath(filename).encode("utf-8")).hexdigest() + ".json")
+
+
+def probe(filename, sidecar=True):
+    """Duration, streams and codecs of a media file, and the number and total length of its tracks.
+
+    The tracks of a ZIP upload are the files in it, the duration is the length of the longest one. With sidecar, the result is stored in data/probe and ffprobe only runs again if the size or the
+    modification time of the file changed. Temporary files should be probed without sidecar.
+    """
+    stat = os.stat(filename)
+    if sidecar:
+        try:
+            with open(probe_file(filename), "r") as f:
+                info = json.load(f)
+            if info["size"] == stat.st_size and info["mtime"] == stat.st_mtime:
+                return info
+        except (FileNotFoundError, ValueError, KeyError):
+            pass
+
+    info = {"path": abspath(filename), "size": stat.st_size, "mtime": stat.st_mtime}
+    if filename.lower().endswith(".zip"):
+        info.update(probe_zip(filename))
+    else:
+        cmd = ["ffprobe", "-v", "error", "-show_entries", "format=duration:stream=codec_type,codec_name"]
+        out = subprocess.run(cmd + ["-of", "json", filename], capture_output=True, check=True).stdout
+        result = json.loads(out)
+        info["duration"] = float(result.get("format", {}).get("duration", 0))
+        info["streams"] = [
+            {"type": stream.get("codec_type"), "codec": stream.get("codec_name")}
+            for stream in result.get("streams", [])
+        ]
+        info["tracks"] = 1
+        info["audio_seconds"] = info["duration"]
+
+    if sidecar:
+        os.makedirs(join(ROOT, "data", "probe"), exist_ok=True)
+        # The GUI and several workers may probe the same file, each one writes its own temporary file
+        fd, tmp = tempfile.mkstemp(dir=join(ROOT, "data", "probe"), suffix=".tmp")
+        with os.fdopen(fd, "w") as f:
+            json.dump(info, f)
+        os.replace(tmp, probe_file(filename))
+    return info
+
+
+def probe_zip(filename):
+    """Probe the files with an audio stream in a ZIP upload, one file extracted at a time."""
+    durations = []
+    streams = []
+    with tempfile.TemporaryDirectory() as tmp, zipfile.ZipFile(filename, "r") as zip_ref:
+        for member in zip_ref.infolist():
+            if member.is_dir():
+                continue
+            path = zip_ref.extract(member, tmp)
+            try:
+                info = probe(path, sidecar=False)
+            except (subprocess.CalledProcessError, ValueError):
+                continue
+            finally:
+                os.remove(path)
+            if any(stream["type"] == "audio" for stream in info["streams"]):
+                durations.append(info["duration"])
+                streams += info["streams"]
+    return {
+        "duration": max(durations, default=0),
+        "streams": streams,
+        "tracks": len(durations),
+        "audio_seconds": sum(durations),
+    }
+
+
+def remove_probe(filename):
     try:
-        # For now, we don't predict the wait time for zipped files in the queue.
-        if filename[-4:] == ".zip":
-            return 1, 1
-        run_time = get_length(filename)
+        os.remove(probe_file(filename))
+    except FileNotFoundError:
+        pass
+
+
+def has_audio(filename, sidecar=True):
+    try:
+        return any(stream["type"] == "audio" for stream in probe(filename, sidecar)["streams"])
+    except (OSError, ValueError, subprocess.CalledProcessError) as e:
+        print(e)
+        return False
+
+
+def get_length(filename, sidecar=True):
+    return probe(filename, sidecar)["duration"]
+
+
+def time_estimate(filename, online=True, sidecar=True):
+    """Estimated processing time and length of a file in seconds, -1, -1 if the file cannot be read.
+
+    The estimate is learned from the past jobs on this device, see src/eta.py, with a fixed real-time
+    factor as fallback while there are not enough recent jobs.
+    """
+    try:
+        info = probe(filename, sidecar)
+        run_time = info["duration"]
+        # Probe results stored before tracks were counted
+        audio_seconds = info.get("audio_seconds", run_time)
+        tracks = info.get("tracks", 1)
+
+        estimate = eta.predict(ROOT, DEVICE, audio_seconds, tracks)
+        if estimate is not None:
+            return estimate, run_time
         if online:
             if DEVICE == "mps":
-                return run_time / 5, run_time
+                return audio_seconds / 5, run_time
             else:
-                return run_time / 10, run_time
+                return audio_seconds / 10, run_time
         else:
             if DEVICE == "mps":
-                return run_time / 3, run_time
+                return audio_seconds / 3, run_time
             else:
-                return run_time / 6, run_time
+                return audio_seconds / 6, run_time
     except Exception as e:
         print(e)
         return -1, -1
@@ -3,6 +3,8 @@ import datetime
 from os.path import join
 from dotenv import load_dotenv
 
+from src import segments
+
 
 load_dotenv()
 
@@ -30,6 +32,40 @@ def create_viewer(data, file_path, encode_base64, combine_speaker, root, languag
     return html
 
 
+def speaker_lists(data):
+    """Speakers as listed in the editor and in the order of their first segment.
+
+    Both lists end with the additional speakers and "unknown". The n-th speaker in order of appearance is
+    shown as the n-th speaker of the editor.
+    """
+    speakers = sorted(set([segment["speaker"] for segment in data if segment["speaker"] != "unknown"]))
+    n_speakers = len(speakers)
+    for i in range(ADDITIONAL_SPEAKERS):
+        speakers.append(str(n_speakers + i).zfill(2))
+    speakers.append("unknown")
+    speaker_order = []
+    for segment in data:
+        if segment["speaker"] not in speaker_order and segment["speaker"] != "unknown":
+            speaker_order.append(segment["speaker"])
+
+    for i in range(ADDITIONAL_SPEAKERS):
+        speaker_order.append(str(n_speakers + i).zfill(2))
+    speaker_order.append("unknown")
+    return speakers, speaker_order
+
+
+def speaker_names(data):
+    """Name of every speaker as it is selected in the editor, see transcript()."""
+    speakers, speaker_order = speaker_lists(data)
+    names = {}
+    for speaker, sorted_speaker in zip(speaker_order, speakers):
+        if sorted_speaker == "unknown":
+            names[speaker] = "Person unbekannt"
+        else:
+            names[speaker] = f"Person {str(sorted_speaker[-2:]).zfill(2)}"
+    return names
+
+
 def header(root):
     content = ""
     with open(root + "data/bootstrap_content.txt", "r") as f:
@@ -119,21 +155,9 @@ def transcript(data, combine_speaker, language):
     content = '\t\t<div class="col-md-6" style="width: 60%; max-width: 90ch; z-index: 1; margin-left: auto; margin-right: auto">\n'
     content += '\t\t\t<div class="wrapper" style="margin: 0.5rem auto 0; max-width: 80ch;" id="editor">\n'
 
-    speakers = sorted(set([segment["speaker"] for segment in data if segment["speaker"] != "unknown"]))
-    n_speakers = len(speakers)
-    for i in range(ADDITIONAL_SPEAKERS):
-        speakers.append(str(n_speakers + i).zfill(2))
-    speakers.append("unknown")
-    speaker_order = []
+    speakers, speaker_order = speaker_lists(data)
     table_elements = ""
     last_speaker = None
-    for segment in data:
-        if segment["speaker"] not in speaker_order and segment["speaker"] != "unknown":
-            speaker_order.append(segment["speaker"])
-
-    for i in range(ADDITIONAL_SPEAKERS):
-        speaker_order.append(str(n_speakers + i).zfill(2))
-    speaker_order.append("unknown")
 
     for i, segment in enumerate(data):
         if last_speaker is not None and not segment["speaker"][-1] == last_speaker:
@@ -274,7 +298,7 @@ vid.ontimeupdate = function() {highlightFunction()};"""
     timestamps = "Array("
     for segment in data:
         timestamps += f"Array({segment['start']}, {segment['end']}), "
-    if len(data) > 0:
+    if timestamps.endswith(", "):
         timestamps = timestamps[:-2] + ");"
     else:
         timestamps += ");"
@@ -584,26 +608,12 @@ def write_content_summary(summary, lines, file_name):
         
         
 def read_content_summary(file_name):
-	lines = ''
+	"""Transcript of a .todosummary file as "speaker: text" lines, and the HTML of the editor."""
 	with open(file_name, 'r', encoding = 'utf-8') as f:
 		lines = f.read()
-		
-	content_out = ''
 
-	index = lines.find('selected="selected">')
-	content = lines[index + len('selected="selected">'):]
-	content = content[:content.find('<script language="javascript">')]
-	while index > -1:
-		content_out += content[:content.find('</option>')] + ': '
-		
-		index = content.find('class="segment" title=')
-		if index == -1:
-			break
-		else:
-			content = content[index + len('class="segment" title="0:00:02 - 0:00:04">'):]
-			content_out += content[:content.find('</span>')] + '\n'
-
-		index = content.find('selected="selected">')
-		content = content[index + len('selected="selected">'):]
-	
-	return content_out, lines
+	# Transcripts from before the sidecar was introduced are parsed from the HTML
+	records = segments.read(segments.path(os.path.splitext(file_name)[0]))
+	if records is None:
+		records = segments.parse_editor(lines)
+	return segments.transcript_text(records), lines
@@ -1,22 +1,44 @@
 import os
+import copy
 import shutil
 import time
 import fnmatch
 import types
-import ffmpeg
 import torch
 import whisperx
 import zipfile
 import logging
-
-from os.path import isfile, join, normpath, basename, dirname
+import socket
+import threading
+import gc
+import json
+import random
+
+from concurrent.futures import ThreadPoolExecutor
+from os.path import isfile, isdir, join, basename, dirname
+from functools import partial
 from dotenv import load_dotenv
 from pyannote.audio import Pipeline
+from whisperx.asr import WhisperModel
 
-from src.viewer import create_viewer, write_content_summary, read_content_summary
+from src.viewer import create_viewer, write_content_summary, read_content_summary, speaker_names
 from src.srt import create_srt
-from src.transcription import transcribe, get_prompt
-from src.util import time_estimate, isolate_voices
+from src.transcription import (
+    transcribe_audio,
+    align,
+    add_languages,
+    diarize,
+    clean_segments,
+    get_prompt,
+    load_align_model,
+    autotune_batch_size,
+    MergedSegments,
+    ALIGN_CACHE_SIZE,
+)
+from src.util import time_estimate, isolate_voices, load_audio, has_audio, SAMPLE_RATE
+from src.pipeline import start_pipeline, run_item
+from src import jobs, checkpoint, cache, eta, metrics, segments, summaries
+from src.profiling import profiled
 
 # Load environment variables
 load_dotenv()
@@ -26,20 +48,59 @@ ONLINE = os.getenv("ONLINE") == "True"
 DEVICE = os.getenv("DEVICE")
 ROOT = os.getenv("ROOT")
 WINDOWS = os.getenv("WINDOWS") == "True"
-BATCH_SIZE = int(os.getenv("BATCH_SIZE"))
+# "auto" measures the best batch size for the hardware at the first start, see tuned_batch_size()
+AUTOTUNE = os.getenv("BATCH_SIZE", "4") == "auto"
+BATCH_SIZE = 4 if AUTOTUNE else int(os.getenv("BATCH_SIZE", "4"))
 SUMMARIZATION = os.getenv("SUMMARIZATION") == "True"
+# A worker with TRANSCRIPTION=False only creates summaries, so they can run in a process of their own
+TRANSCRIPTION = os.getenv("TRANSCRIPTION", "True") == "True"
+# Number of summaries created in parallel, each with its own copy of the language model
+SUMMARY_WORKERS = int(os.getenv("SUMMARY_WORKERS", "1"))
+# Context size of the language model in tokens, the memory of its cache grows with it
+SUMMARY_CONTEXT = int(os.getenv("SUMMARY_CONTEXT", "32768"))
+# Tokens of the context reserved for the answer when a transcript is split, the answer may use all the
+# context left after the prompt
+SUMMARY_ANSWER_TOKENS = 2048
+SUMMARY_MODEL_REPO = "bartowski/Qwen2.5-7B-Instruct-1M-GGUF"
+SUMMARY_MODEL_FILE = "Qwen2.5-7B-Instruct-1M-Q6_K.gguf"
+WORKER_ID = os.getenv("WORKER_ID") or f"{socket.gethostname()}-{os.getpid()}"
+LEASE_TIMEOUT = int(os.getenv("LEASE_TIMEOUT", "120"))
+WORKERS = int(os.getenv("WORKERS", "1"))
+# Number of tracks of a ZIP file that are transcribed in parallel. Every track needs the memory of a batch of
+# BATCH_SIZE, and on CPU the tracks share the cores of Whisper, so by default they are transcribed one after another.
+TRACK_WORKERS = int(os.getenv("TRACK_WORKERS", "1"))
+# On MPS the worker restarts after every transcription, so jobs are processed one after another.
+PIPELINE = os.getenv("PIPELINE", "True") == "True" and DEVICE != "mps"
+AUDIO_FILTER = "lowpass=3000,highpass=200"
+# Compute type of Whisper, defaults to int8 on CPU and float16 on GPU
+COMPUTE_TYPE = os.getenv("COMPUTE_TYPE")
+# Share of the cores for Whisper, for alignment and diarization, and for the language model on CPU
+CPU_SPLIT = os.getenv("CPU_SPLIT", "2:1:1")
+# Size of the cache of finished transcripts in data/cache in MB, 0 disables the cache
+RESULT_CACHE_SIZE = int(os.getenv("RESULT_CACHE_SIZE", "1000"))
+# Load the alignment models of the languages used most in the last jobs at startup
+ALIGN_PRELOAD = os.getenv("ALIGN_PRELOAD", "True") == "True"
+# JSON-lines log of the resource usage of every job, read by the /metrics endpoint of the GUI
+METRICS_LOG = os.getenv("METRICS_LOG", join(ROOT, "data", "metrics.jsonl"))
+# Share of the jobs that are profiled, see profile_dir()
+PROFILE_RATE = float(os.getenv("PROFILE_RATE", "0"))
+# Seconds without a summary after which the language model is unloaded, 0 keeps it loaded
+LLM_IDLE_TIMEOUT = float(os.getenv("LLM_IDLE_TIMEOUT", "600"))
 
 if SUMMARIZATION:
     from llama_cpp import Llama
     from huggingface_hub import hf_hub_download
-    from transformers import AutoTokenizer
-    import json
 
 
 # Set up logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Per-thread connections to the job index, see db()
+local = threading.local()
+# Summaries this process works on, their claims are renewed by heartbeat()
+summary_claims = set()
+
 if WINDOWS:
     os.environ["PATH"] += os.pathsep + "ffmpeg/bin"
     os.environ["PATH"] += os.pathsep + "ffmpeg"
@@ -57,154 +118,601 @@ def report_error(file_name, file_name_error, user_id, text=""):
     shutil.move(file_name, file_name_error)
 
 
-def oldest_files(folder):
-    matches = []
-    times = []
-    for root, _, filenames in os.walk(folder):
-        for filename in fnmatch.filter(filenames, "*.*"):
-            file_path = join(root, filename)
-            matches.append(file_path)
-            times.append(os.path.getmtime(file_path))
-    return [m for _, m in sorted(zip(times, matches))]
-
-
-def transcribe_file(
-    file_name, multi_mode=False, multi_mode_track=None, audio_files=None, language="de"
-):
-    data = None
-    estimated_time = 0
-    progress_file_name = ""
-
-    file = basename(file_name)
-    user_id = normpath(dirname(file_name)).split(os.sep)[-1]
-    file_name_error = join(ROOT, "data", "error", user_id, file)
-    file_name_out = join(ROOT, "data", "out", user_id, file + ".mp4")
-
-    # Clean up worker directory
-    if not multi_mode:
-        worker_user_dir = join(ROOT, "data", "worker", user_id)
-        if os.path.exists(worker_user_dir):
+def scratch_dir(worker_id, name):
+    """Private working directory of a worker, so several workers can share data/."""
+    path = join(ROOT, "data", "scratch", worker_id, name)
+    shutil.rmtree(path, ignore_errors=True)
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def remove_progress_files(worker_user_dir, file):
+    """Remove progress files of a file left behind by a crashed worker."""
+    if not os.path.exists(worker_user_dir):
+        return
+    for f in os.listdir(worker_user_dir):
+        if "_".join(f.split("_")[2:]) == file:
             try:
-                shutil.rmtree(worker_user_dir)
+                os.remove(join(worker_user_dir, f))
             except OSError as e:
-                logger.error(f"Could not remove folder: {worker_user_dir}. Error: {e}")
+                logger.error(f"Could not remove progress file: {f}. Error: {e}")
+
+
+def heartbeat():
+    """Renew the leases of the jobs of this worker until the process exits."""
+    while True:
+        time.sleep(LEASE_TIMEOUT / 4)
+        try:
+            for worker_id in worker_ids():
+                jobs.heartbeat(db(), worker_id, LEASE_TIMEOUT)
+        except Exception as e:
+            logger.exception("Could not renew job leases")
+        for claim in list(summary_claims):
+            try:
+                os.utime(claim)
+            except OSError as e:
+                logger.error(f"Could not renew summary claim: {claim}. Error: {e}")
+
+
+def db():
+    """Connection to the job index for the current thread."""
+    if not hasattr(local, "conn"):
+        local.conn = jobs.connect(ROOT)
+    return local.conn
+
+
+def create_proxy(file_name, file_name_out):
+    """Convert and filter the file for the player in the editor."""
+    exit_status = os.system(
+        f'ffmpeg -y -i "{file_name}" -filter:v scale=320:-2 -af "{AUDIO_FILTER}" "{file_name_out}"'
+    )
+    if exit_status == 256:
+        exit_status = os.system(
+            f'ffmpeg -y -i "{file_name}" -c:v copy -af "{AUDIO_FILTER}" "{file_name_out}"'
+        )
+    if not exit_status == 0:
+        logger.exception("ffmpeg error during audio processing")
+
 
-    # Create output directory
-    if not multi_mode:
-        output_user_dir = join(ROOT, "data", "out", user_id)
-        os.makedirs(output_user_dir, exist_ok=True)
+def cpu_split():
+    """Cores for Whisper, for alignment and diarization with torch, and for the language model.
 
-    # Estimate run time
+    The groups do not overlap unless there are fewer cores than groups.
+    """
+    if hasattr(os, "sched_getaffinity"):
+        cores = sorted(os.sched_getaffinity(0))
+    else:
+        cores = list(range(os.cpu_count()))
     try:
-        time.sleep(2)
-        estimated_time, run_time = time_estimate(file_name, ONLINE)
-        if run_time == -1:
-            report_error(
-                file_name, file_name_error, user_id, "Datei konnte nicht gelesen werden"
-            )
-            return data, estimated_time, progress_file_name
+        weights = [int(weight) for weight in CPU_SPLIT.split(":")]
+    except ValueError:
+        weights = []
+    if len(weights) != 3 or min(weights) < 0 or sum(weights) == 0:
+        raise ValueError(f"CPU_SPLIT must be three non-negative whole numbers like 2:1:1, got {CPU_SPLIT}")
+    if not SUMMARIZATION:
+        weights[2] = 0
+
+    counts = [max(1, len(cores) * weight // sum(weights)) if weight else 0 for weight in weights]
+    # Cores left over by rounding go to Whisper
+    counts[0] += max(0, len(cores) - sum(counts))
+
+    split = {"all": cores}
+    start = 0
+    for name, count in zip(["asr", "torch", "llm"], counts):
+        split[name] = [cores[(start + i) % len(cores)] for i in range(count)]
+        start += count
+    return split
+
+
+def pin(cores):
+    """Run the calling thread, and the threads it starts from now on, on the given cores."""
+    if cores and hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, cores)
+
+
+def pinned(func, cores):
+    """Pin the thread that runs a stage before every item, see pin()."""
+    if not cores:
+        return func
+
+    def run(item):
+        pin(cores)
+        return func(item)
+
+    return run
+
+
+def profile_dir(user_id, file):
+    """Directory for the profiles of a job, or None if the job is not profiled.
+
+    A job is profiled if an empty file <file>.profile exists next to its outputs, or by chance with PROFILE_RATE.
+    """
+    out_dir = join(ROOT, "data", "out", user_id)
+    if isfile(join(out_dir, file + ".profile")) or random.random() < PROFILE_RATE:
+        return join(out_dir, file + ".prof")
+    return None
+
+
+def create_item(job, worker_id, admission=None):
+    """State of a job while it moves through the stages of the pipeline.
+
+    admission is released when the job starts the transcription, so the slot can claim the next job,
+    see run_worker().
+    """
+    user_id = job["user_id"]
+    file = job["file_name"]
+    return {
+        "job": job,
+        "worker_id": worker_id,
+        "admission": admission,
+        "user_id": user_id,
+        "file": file,
+        "file_name": join(ROOT, "data", "in", user_id, file),
+        "file_name_error": join(ROOT, "data", "error", user_id, file),
+        "file_name_out": join(ROOT, "data", "out", user_id, file + ".mp4"),
+        "language": job["language"],
+        "hotwords": job["hotwords"].splitlines(),
+        "estimated_time": 0,
+        "duration": 0,
+        "audio_seconds": 0,
+        "progress_file_name": "",
+        "zip_dir": None,
+        "checkpoint_dir": None,
+        "cache_key": None,
+        "data": None,
+        "cached": False,
+        "resumed": False,
+        "state": None,
+        "timings": {},
+        "usage": {},
+        "claimed": time.time(),
+        "profile_dir": profile_dir(user_id, file),
+        "tracks": [],
+    }
+
+
+def admit_next(item):
+    """Let the slot of the job claim its next job, once per job."""
+    if item["admission"] is not None:
+        item["admission"].release()
+        item["admission"] = None
+
+
+def finish(item, state):
+    """Mark the job as done or failed and clean up its temporary files."""
+    admit_next(item)
+    item["state"] = state
+    jobs.finish(db(), item["job"]["id"], item["worker_id"], state)
+    # Finished jobs are logged after the render stage, so that its usage is included
+    if state == jobs.ERROR:
+        log_metrics(item)
+    if item["progress_file_name"] and os.path.exists(item["progress_file_name"]):
+        os.remove(item["progress_file_name"])
+    if item["zip_dir"]:
+        shutil.rmtree(item["zip_dir"], ignore_errors=True)
+    checkpoint.remove(ROOT, item["user_id"], item["file"])
+
+
+def fail(item, text):
+    # The job is finished even if the upload can no longer be moved, e.g. because it was deleted
+    try:
+        report_error(item["file_name"], item["file_name_error"], item["user_id"], text)
+    finally:
+        finish(item, jobs.ERROR)
+
+
+def prepare(item):
+    """Estimate the run time, check the audio stream and decode the audio."""
+    # A job that was interrupted resumes after the last stage it completed
+    item["checkpoint_dir"] = checkpoint.job_dir(ROOT, item["user_id"], item["file"], item["file_name"])
+    item["resumed"] = any(
+        file.endswith(".json") for _, _, files in os.walk(item["checkpoint_dir"]) for file in files
+    )
+    if item["file_name"].lower().endswith(".zip"):
+        return prepare_zip(item)
+
+    try:
+        estimated_time, run_time = time_estimate(item["file_name"], ONLINE)
     except Exception as e:
         logger.exception("Error estimating run time")
-        report_error(
-            file_name, file_name_error, user_id, "Datei konnte nicht gelesen werden"
+        run_time = -1
+    if run_time == -1:
+        fail(item, "Datei konnte nicht gelesen werden")
+        return None
+    item["estimated_time"] = estimated_time
+    item["duration"] = run_time
+
+    if not has_audio(item["file_name"]):
+        fail(item, "Die Tonspur der Datei konnte nicht gelesen werden")
+        return None
+
+    # The model gets the same filtered audio as the player in the editor
+    item["tracks"] = [
+        {
+            "file_name": item["file_name"],
+            "audio": load_audio(
+                item["file_name"], AUDIO_FILTER, audio_file=join(item["checkpoint_dir"], "audio.f32")
+            ),
+            "multi_mode_track": None,
+            "checkpoint_dir": item["checkpoint_dir"],
+        }
+    ]
+    return lookup_cache(item)
+
+
+def prepare_zip(item):
+    """Extract the tracks of a ZIP file, isolate the voices and decode every track."""
+    item["zip_dir"] = scratch_dir(item["worker_id"], f"zip_{item['job']['id']}")
+    with zipfile.ZipFile(item["file_name"], "r") as zip_ref:
+        zip_ref.extractall(item["zip_dir"])
+
+    # Collect files from zip
+    audio_files = []
+    for root, _, filenames in os.walk(item["zip_dir"]):
+        audio_files += [join(root, fn) for fn in filenames if fnmatch.fnmatch(fn, "*.*")]
+    # A stable order keeps the speaker labels and checkpoints of the tracks the same on a restart
+    audio_files.sort()
+    for file_path in list(audio_files):
+        if not has_audio(file_path, sidecar=False):
+            logger.error(f"Skipping track without audio stream: {basename(file_path)}")
+            audio_files.remove(file_path)
+    if not audio_files:
+        fail(item, "Die Tonspur der Datei konnte nicht gelesen werden")
+        return None
+    estimated_time, duration = time_estimate(item["file_name"], ONLINE)
+    item["estimated_time"] = max(estimated_time, 1)
+    item["duration"] = max(duration, 0)
+
+    # isolate_voices decodes every track anyway, so its output is used for the transcription directly
+    track_dirs = [join(item["checkpoint_dir"], f"track_{track}") for track in range(len(audio_files))]
+    isolated = isolate_voices(audio_files, [join(track_dir, "audio.f32") for track_dir in track_dirs])
+    for track, (file_path, audio) in enumerate(zip(audio_files, isolated)):
+        if len(audio) == 0:
+            logger.error(f"Skipping track without audio: {basename(file_path)}")
+            continue
+        item["tracks"].append(
+            {
+                "file_name": file_path,
+                "audio": audio,
+                "multi_mode_track": track,
+                "checkpoint_dir": track_dirs[track],
+            }
+        )
+    if not item["tracks"]:
+        fail(item, "Die Tonspur der Datei konnte nicht gelesen werden")
+        return None
+    return lookup_cache(item)
+
+
+def lookup_cache(item):
+    """Use the transcript of an earlier upload of the same audio, if it is still cached."""
+    item["audio_seconds"] = sum(len(track["audio"]) for track in item["tracks"]) / SAMPLE_RATE
+    if RESULT_CACHE_SIZE <= 0 or not item["tracks"]:
+        return item
+    item["cache_key"] = cache.key(
+        [track["audio"] for track in item["tracks"]], item["language"], item["hotwords"], MODEL_ID
+    )
+    data_parts = cache.load(ROOT, item["cache_key"])
+    if data_parts is not None:
+        item["data"] = MergedSegments(data_parts)
+        item["cached"] = True
+        logger.info(f"Using cached transcript for {item['file']}")
+        for track in item["tracks"]:
+            track["audio"] = None
+    return item
+
+
+def transcode(item):
+    """Create the file for the player in the editor, for ZIP files from the mix of all tracks."""
+    os.makedirs(join(ROOT, "data", "out", item["user_id"]), exist_ok=True)
+    if item["zip_dir"] is None:
+        create_proxy(item["file_name"], item["file_name_out"])
+        return item
+
+    # Merge audio files
+    output_audio = join(item["zip_dir"], "tmp.mp4")
+    ffmpeg_input = " ".join(f'-i "{track["file_name"]}"' for track in item["tracks"])
+    ffmpeg_cmd = f'ffmpeg {ffmpeg_input} -filter_complex amix=inputs={len(item["tracks"])}:duration=first "{output_audio}"'
+    os.system(ffmpeg_cmd)
+    create_proxy(output_audio, item["file_name_out"])
+    return item
+
+
+def asr(item, model):
+    admit_next(item)
+    worker_user_dir = join(ROOT, "data", "worker", item["user_id"])
+    remove_progress_files(worker_user_dir, item["file"])
+    os.makedirs(worker_user_dir, exist_ok=True)
+    item["progress_file_name"] = join(
+        worker_user_dir, f"{item['estimated_time']}_{int(time.time())}_{item['file']}"
+    )
+    try:
+        with open(item["progress_file_name"], "w") as f:
+            f.write("")
+    except OSError as e:
+        logger.error(f"Could not create progress file: {item['progress_file_name']}. Error: {e}")
+
+    # Cache hit, see lookup_cache()
+    if item["data"] is not None:
+        return item
+
+    torch.cuda.empty_cache()
+    map_tracks(partial(asr_track, item=item, model=model), item["tracks"])
+    return item
+
+
+def asr_track(track, item, model):
+    # The hotwords are set on the pipeline options, so tracks transcribed in parallel need their own copy.
+    track_model = model if len(item["tracks"]) == 1 else copy.copy(model)
+    track["result"] = transcribe_audio(
+        track["file_name"],
+        track["audio"],
+        track_model,
+        hotwords=item["hotwords"],
+        batch_size=BATCH_SIZE,
+        language=item["language"],
+        checkpoint_dir=track["checkpoint_dir"],
+    )
+    track["language"] = track["result"]["language"]
+
+
+def alignment(item, model):
+    if item["data"] is not None:
+        return item
+    map_tracks(partial(alignment_track, item=item, model=model), item["tracks"])
+    return item
+
+
+def alignment_track(track, item, model):
+    track["result"] = align(track["result"], track["audio"], DEVICE, track["checkpoint_dir"])
+    # on MPS is rather slow and unreliable, but you can try with enabling it there as well
+    if DEVICE != "mps":
+        track["result"] = add_languages(
+            track["result"],
+            track["audio"],
+            model,
+            hotwords=item["hotwords"],
+            language=item["language"],
+            batch_size=BATCH_SIZE,
+            checkpoint_dir=track["checkpoint_dir"],
         )
-        return data, estimated_time, progress_file_name
 
-    if not multi_mode:
-        worker_user_dir = join(ROOT, "data", "worker", user_id)
-        os.makedirs(worker_user_dir, exist_ok=True)
-        progress_file_name = join(
-            worker_user_dir, f"{estimated_time}_{int(time.time())}_{file}"
+
+def map_tracks(func, tracks):
+    """Run func on every track, the tracks of a ZIP file in parallel."""
+    if len(tracks) == 1 or TRACK_WORKERS == 1:
+        return [func(track) for track in tracks]
+    with ThreadPoolExecutor(min(TRACK_WORKERS, len(tracks))) as executor:
+        return list(executor.map(func, tracks))
+
+
+def diarization(item):
+    if item["data"] is not None:
+        return item
+    data_parts = []
+    for track in item["tracks"]:
+        result = diarize(
+            track["result"],
+            track["audio"],
+            diarize_model,
+            None,
+            track["multi_mode_track"],
+            track["checkpoint_dir"],
         )
+        data_parts.append(clean_segments(result, track["language"]))
+        # The decoded audio is not needed anymore
+        track["audio"] = None
+        track["result"] = None
+
+    # The tracks are merged by start time while the editor and the SRT file are written
+    item["data"] = MergedSegments(data_parts)
+    if item["cache_key"]:
         try:
-            with open(progress_file_name, "w") as f:
-                f.write("")
+            cache.save(ROOT, item["cache_key"], data_parts, RESULT_CACHE_SIZE * 1024 * 1024)
         except OSError as e:
-            logger.error(
-                f"Could not create progress file: {progress_file_name}. Error: {e}"
-            )
+            logger.error(f"Could not cache transcript of {item['file']}. Error: {e}")
+    return item
 
-    # Check if file has a valid audio stream
-    try:
-        if not ffmpeg.probe(file_name, select_streams="a")["streams"]:
-            report_error(
-                file_name,
-                file_name_error,
-                user_id,
-                "Die Tonspur der Datei konnte nicht gelesen werden",
-            )
-            return data, estimated_time, progress_file_name
-    except ffmpeg.Error as e:
-        logger.exception("ffmpeg error during probing")
-        report_error(
-            file_name,
-            file_name_error,
-            user_id,
-            "Die Tonspur der Datei konnte nicht gelesen werden",
-        )
-        return data, estimated_time, progress_file_name
 
-    # Process audio
-    if not multi_mode:
-        # Convert and filter audio
-        exit_status = os.system(
-            f'ffmpeg -y -i "{file_name}" -filter:v scale=320:-2 -af "lowpass=3000,highpass=200" "{file_name_out}"'
+def render(item):
+    """Write the editor, the SRT file and the segments sidecar."""
+    user_id = item["user_id"]
+    file = item["file"]
+    try:
+        srt = create_srt(item["data"])
+        viewer = create_viewer(item["data"], item["file_name_out"], True, False, ROOT, item["language"])
+
+        file_name_viewer = join(ROOT, "data", "out", user_id, file + ".html")
+        file_name_srt = join(ROOT, "data", "out", user_id, file + ".srt")
+        with open(file_name_viewer, "w", encoding="utf-8") as f:
+            f.write(viewer)
+        with open(file_name_srt, "w", encoding="utf-8") as f:
+            f.write(srt)
+        # Summaries and exports read the segments from the sidecar instead of the HTML of the editor
+        segments.write(
+            segments.path(join(ROOT, "data", "out", user_id, file)),
+            segments.records(item["data"], speaker_names(item["data"])),
         )
-        if exit_status == 256:
-            exit_status = os.system(
-                f'ffmpeg -y -i "{file_name}" -c:v copy -af "lowpass=3000,highpass=200" "{file_name_out}"'
-            )
-        if not exit_status == 0:
-            logger.exception("ffmpeg error during audio processing")
-            file_name_out = file_name  # Fallback to original file
 
+        logger.info(f"Estimated Time: {item['estimated_time']}")
+    except Exception as e:
+        logger.exception("Error creating editor")
+        fail(item, "Fehler beim Erstellen des Editors")
     else:
-        file_name_out = file_name
+        finish(item, jobs.DONE)
+    return item
 
-    # Load hotwords
-    hotwords = []
-    hotwords_file = join(ROOT, "data", "in", user_id, "hotwords.txt")
-    if isfile(hotwords_file):
-        with open(hotwords_file, "r") as h:
-            hotwords = h.read().splitlines()
 
-    # Transcribe
+def on_stage_error(item):
     try:
-        data = transcribe(
-            file_name_out,
-            model,
-            diarize_model,
-            DEVICE,
-            None,
-            add_language=(
-                False if DEVICE == "mps" else True
-            ),  # on MPS is rather slow and unreliable, but you can try with setting this to true
-            hotwords=hotwords,
-            multi_mode_track=multi_mode_track,
-            language=language,
-        )
+        fail(item, "Transkription fehlgeschlagen")
+    finally:
+        admit_next(item)
+
+
+# Names of the stages in the order of run_worker()
+STAGES = ["prepare", "transcode", "asr", "alignment", "diarization", "render"]
+
+
+def log_metrics(item):
+    """Append the resource usage of a finished or failed job to the metrics log."""
+    if not METRICS_LOG:
+        return
+    processing_seconds = sum(usage["seconds"] for usage in item["usage"].values())
+    event = {
+        "time": time.time(),
+        "worker": item["worker_id"],
+        "device": DEVICE,
+        "job_id": item["job"]["id"],
+        "state": "done" if item["state"] == jobs.DONE else "error",
+        # The first stage that did not complete
+        "failed_stage": next((name for name in STAGES if name not in item["usage"]), None)
+        if item["state"] == jobs.ERROR
+        else None,
+        "cached": item["cached"],
+        "resumed": item["resumed"],
+        "tracks": len(item["tracks"]),
+        "audio_seconds": item["audio_seconds"],
+        "processing_seconds": processing_seconds,
+        "rtf": processing_seconds / item["audio_seconds"] if item["audio_seconds"] else None,
+        "queue_wait_seconds": item["claimed"] - item["job"]["submitted"],
+        "stages": item["usage"],
+    }
+    try:
+        metrics.write(METRICS_LOG, event)
     except Exception as e:
-        logger.exception("Transcription failed")
-        report_error(
-            file_name, file_name_error, user_id, "Transkription fehlgeschlagen"
-        )
+        logger.exception("Could not write the metrics of the job")
+
+
+def on_stage_done(name, item, usage):
+    item["timings"][name] = usage["seconds"]
+    item["usage"][name] = usage
+    if name != "render":
+        return
+
+    if item["state"] == jobs.DONE:
+        log_metrics(item)
+
+    # Jobs restored from the cache or from checkpoints would distort the learned estimates
+    if item["state"] == jobs.DONE and not item["cached"] and not item["resumed"]:
+        try:
+            jobs.record_run(
+                db(),
+                item["job"]["id"],
+                item["worker_id"],
+                DEVICE,
+                item["duration"],
+                item["audio_seconds"],
+                len(item["tracks"]),
+                item["timings"],
+            )
+            eta.fit(db(), ROOT, DEVICE)
+        except Exception as e:
+            logger.exception("Could not record the run time of the job")
 
-    return data, estimated_time, progress_file_name
+    if DEVICE == "mps":
+        print("Exiting worker to prevent memory leaks with MPS...")
+        exit(
+            0
+        )  # Due to memory leak problems, we restart the worker after each transcription
 
 
-def summarize(text, llm, encoder):
+def load_llm(llm_state):
+    """The language model of a summarizer thread, loaded on first use."""
+    if llm_state["llm"] is None:
+        logger.info("Loading summarization model")
+        model_path = hf_hub_download(repo_id=SUMMARY_MODEL_REPO, filename=SUMMARY_MODEL_FILE)
+        llm_state["llm"] = Llama(
+            model_path=model_path,
+            n_ctx=SUMMARY_CONTEXT,
+            n_gpu_layers=0,
+            n_threads=len(cores.get("llm", [])) or 8,
+            use_mmap=True,
+            use_mlock=False,
+            verbose=False,
+        )
+    llm_state["used"] = time.time()
+    return llm_state["llm"]
+
+
+def unload_idle_llm(llm_state):
+    """Free the memory of the language model after LLM_IDLE_TIMEOUT seconds without a summary."""
+    if llm_state["llm"] is None or LLM_IDLE_TIMEOUT <= 0:
+        return
+    if time.time() - llm_state["used"] < LLM_IDLE_TIMEOUT:
+        return
+    logger.info("Unloading idle summarization model")
+    if hasattr(llm_state["llm"], "close"):
+        llm_state["llm"].close()
+    llm_state["llm"] = None
+    gc.collect()
+
+
+SUMMARY_SYSTEM = "Du bist Qwen, du verfasst Zusammenfassungen auf Deutsch und antwortest im JSON-Format"
+SUMMARY_RULES = "Verwende nur die gegebenen Informationen, erfinde keine Zusätzlichen Fakten. Erwähne die wichtigen Details, wie zum Beispiel Orte, Personen oder Ereignisse. Strukturiere die Zusammenfassung in unterschiedliche Themen. Jedes Thema hat einen Namen und einen Inhalt. Formuliere sachlich und neutral. Schreib prägnant und auf Deutsch."
+# The prompts start with the same instructions. llama.cpp keeps the matching start of the previous prompt
+# in its cache, so the instructions are only evaluated for the first summary after the model is loaded.
+SUMMARY_PROMPT = f"""{SUMMARY_RULES}
+Fasse das folgende Transkript zusammen.
+Transkipt: """
+PART_PROMPT = f"""{SUMMARY_RULES}
+Fasse den folgenden Ausschnitt eines Transkripts zusammen.
+Ausschnitt: """
+COMBINE_PROMPT = f"""{SUMMARY_RULES}
+Die folgenden Themen fassen aufeinanderfolgende Ausschnitte desselben Transkripts zusammen. Fasse sie zu einer Zusammenfassung des ganzen Transkripts zusammen und führe gleiche Themen zusammen.
+Themen: """
+
+
+def count_tokens(llm, text):
+    return len(llm.tokenize(text.encode("utf-8"), add_bos=False))
+
+
+def split_transcript(llm, text, max_tokens):
+    """Split a transcript into chunks of at most max_tokens tokens, preferably between speaker turns.
+
+    A line of the transcript is a segment in the form "speaker: text". Turns that do not fit into a
+    chunk are split between their segments, and segments that do not fit are cut off.
+    """
+    turns = []
+    for line in text.splitlines(keepends=True):
+        speaker = line.split(": ", 1)[0]
+        if turns and turns[-1][0] == speaker:
+            turns[-1][1].append(line)
+        else:
+            turns.append((speaker, [line]))
+
+    units = []
+    for _, lines in turns:
+        turn = "".join(lines)
+        tokens = count_tokens(llm, turn)
+        if tokens <= max_tokens:
+            units.append((turn, tokens))
+            continue
+        for line in lines:
+            tokens = llm.tokenize(line.encode("utf-8"), add_bos=False)
+            if len(tokens) > max_tokens:
+                line = llm.detokenize(tokens[:max_tokens]).decode("utf-8", errors="ignore")
+            units.append((line, min(len(tokens), max_tokens)))
+
+    chunks = []
+    chunk, chunk_tokens = "", 0
+    for unit, tokens in units:
+        if chunk and chunk_tokens + tokens > max_tokens:
+            chunks.append(chunk)
+            chunk, chunk_tokens = "", 0
+        chunk += unit
+        chunk_tokens += tokens
+    if chunk:
+        chunks.append(chunk)
+    return chunks
+
+
+def complete_summary(llm, prompt, text):
+    """Topics of a summary as pairs of name and content."""
     out = llm.create_chat_completion(
         messages=[
-            {
-                "role": "system",
-                "content": "Du bist Qwen, du verfasst Zusammenfassungen auf Deutsch und antwortest im JSON-Format",
-            },
-            {
-                "role": "user",
-                "content": """Fasse das folgende Transkript zusammen. Verwende nur die gegebenen Informationen, erfinde keine Zusätzlichen Fakten. Erwähne die wichtigen Details, wie zum Beispiel Orte, Personen oder Ereignisse. Strukturiere die Zusammenfassung in unterschiedliche Themen. Jedes Thema hat einen Namen und einen Inhalt. Formuliere sachlich und neutral. Schreib prägnant und auf Deutsch.
-Transkipt: """
-                + encoder.decode(encoder(text)["input_ids"][:30000]),
-            },
+            {"role": "system", "content": SUMMARY_SYSTEM},
+            {"role": "user", "content": prompt + text},
         ],
         response_format={
             "type": "json_object",
@@ -218,65 +726,264 @@ Transkipt: """
             },
         },
         temperature=0.5,
+        max_tokens=None,
     )
+    content = json.loads(out["choices"][0]["message"]["content"])
+    return list(zip(content["thema_name"], content["thema_inhalt"]))
+
+
+def summarize(text, llm):
+    """Summarize a transcript as HTML.
+
+    A transcript that does not fit into the context is split at speaker turns and every part is
+    summarized on its own. The topics of the parts are then combined, in several rounds if they do not
+    fit into the context either.
+    """
+    prompt_tokens = count_tokens(llm, SUMMARY_SYSTEM + COMBINE_PROMPT) + 64
+    max_tokens = SUMMARY_CONTEXT - SUMMARY_ANSWER_TOKENS - prompt_tokens
+    chunks = split_transcript(llm, text, max_tokens)
+    if len(chunks) <= 1:
+        topics = complete_summary(llm, SUMMARY_PROMPT, chunks[0] if chunks else text)
+    else:
+        topics = []
+        for index, chunk in enumerate(chunks):
+            logger.info(f"Summarizing part {index + 1} of {len(chunks)}")
+            topics += complete_summary(llm, PART_PROMPT, chunk)
+        while True:
+            chunks = split_transcript(llm, "".join(f"{name}: {content}\n" for name, content in topics), max_tokens)
+            topics = []
+            for chunk in chunks:
+                topics += complete_summary(llm, COMBINE_PROMPT, chunk)
+            # No chunk is left if the parts had no topics
+            if len(chunks) <= 1:
+                break
 
     summary = ""
-    content = json.loads(out["choices"][0]["message"]["content"].replace("ß", "ss"))
-    for i in range(len(content["thema_name"])):
-        if len(content["thema_inhalt"]) == i:
-            break
-        summary += "<b>" + content["thema_name"][i] + "</b><br>"
-        summary += content["thema_inhalt"][i] + "<br>"
+    for name, content in topics:
+        summary += "<b>" + name.replace("ß", "ss") + "</b><br>"
+        summary += content.replace("ß", "ss") + "<br>"
+    return summary
+
 
+def cached_summary(text, llm_state):
+    """Summary of a transcript, from the cache if the same transcript was summarized before."""
+    summary_key = cache.text_key(
+        "summary", SUMMARY_MODEL_FILE, SUMMARY_CONTEXT, SUMMARY_SYSTEM, SUMMARY_RULES, text
+    )
+    if RESULT_CACHE_SIZE > 0:
+        cached = cache.load(ROOT, summary_key)
+        if cached is not None:
+            logger.info("Using cached summary")
+            return cached["summary"]
+
+    summary = summarize(text, load_llm(llm_state))
+    if RESULT_CACHE_SIZE > 0:
+        try:
+            cache.save(ROOT, summary_key, {"summary": summary}, RESULT_CACHE_SIZE * 1024 * 1024)
+        except OSError as e:
+            logger.error(f"Could not cache summary. Error: {e}")
     return summary
 
 
+def tuned_batch_size(model, key):
+    """Best batch size for the hardware, measured once per key and stored in data/batch_size.json."""
+    path = join(ROOT, "data", "batch_size.json")
+    tuned = {}
+    if isfile(path):
+        with open(path, "r") as f:
+            tuned = json.load(f)
+    if key not in tuned:
+        logger.info(f"Measuring the best batch size for {key}")
+        batch_size = autotune_batch_size(model)
+        # Other nodes sharing the data folder may have stored their results in the meantime
+        if isfile(path):
+            with open(path, "r") as f:
+                tuned = json.load(f)
+        tuned[key] = batch_size
+        with open(path + ".tmp", "w") as f:
+            json.dump(tuned, f, indent=4)
+        os.replace(path + ".tmp", path)
+    return tuned[key]
+
+
+def worker_ids():
+    if WORKERS == 1:
+        return [WORKER_ID]
+    return [f"{WORKER_ID}-{index}" for index in range(WORKERS)]
+
+
+def run_worker(index):
+    """Process jobs until the worker is stopped.
+
+    Several worker slots run as threads of one process and share the loaded models.
+    """
+    worker_id = worker_ids()[index]
+    # The hotwords are set on the pipeline options, so every slot needs its own shallow copy of the pipeline.
+    slot_model = model if WORKERS == 1 else copy.copy(model)
+    stages = [
+        ("prepare", pinned(prepare, cores.get("all"))),
+        ("transcode", pinned(transcode, cores.get("all"))),
+        ("asr", pinned(partial(asr, model=slot_model), cores.get("asr"))),
+        ("alignment", pinned(partial(alignment, model=slot_model), cores.get("torch"))),
+        ("diarization", pinned(diarization, cores.get("torch"))),
+        ("render", pinned(render, cores.get("all"))),
+    ]
+    stages = [(name, profiled(name, func)) for name, func in stages]
+
+    jobs.release(db(), worker_id)
+    shutil.rmtree(join(ROOT, "data", "scratch", worker_id), ignore_errors=True)
+
+    # While a job holds the models, the next job is already decoded and transcoded.
+    if PIPELINE:
+        inbox = start_pipeline(stages, on_stage_error, on_done=on_stage_done)
+
+    # A slot claims its next job only when the previous one starts the transcription, so at most one job
+    # per slot waits in the pipeline and the other jobs stay in the queue for the scheduler and other workers.
+    admission = threading.Semaphore(1) if PIPELINE else None
+    while True:
+        if admission is not None:
+            admission.acquire()
+        try:
+            job = jobs.claim(db(), worker_id, LEASE_TIMEOUT)
+        except Exception as e:
+            logger.exception("Error accessing job queue")
+            job = None
+
+        if job is not None:
+            item = create_item(job, worker_id, admission)
+            # Skip files that were deleted while waiting in the queue
+            if not isfile(item["file_name"]):
+                jobs.remove(db(), item["user_id"], item["file"])
+                admit_next(item)
+            elif PIPELINE:
+                inbox.put(item)
+            else:
+                run_item(item, stages, on_stage_error, on_stage_done)
+
+        if job is None:
+            if admission is not None:
+                admission.release()
+            time.sleep(1)
+
+
+def run_summarizer(index):
+    """Create the requested summaries, independently of the transcriptions."""
+    worker_id = f"{WORKER_ID}-summary-{index}"
+    # Every summarizer has its own language model, loaded on the first summary
+    llm_state = {"llm": None, "used": 0.0}
+    pin(cores.get("llm"))
+
+    while True:
+        try:
+            claimed = summaries.claim(ROOT, worker_id, LEASE_TIMEOUT)
+        except Exception as e:
+            logger.exception("Error accessing summary requests")
+            time.sleep(1)
+            continue
+        if claimed is None:
+            unload_idle_llm(llm_state)
+            time.sleep(1)
+            continue
+
+        user_id, file, claim = claimed
+        summary_claims.add(claim)
+        file_name = join(ROOT, "data", "out", user_id, file + ".todosummary")
+        logger.info(f"Summarizing file")
+        try:
+            content_out, lines = read_content_summary(file_name)
+        except Exception as e:
+            # The request is dropped, so that it can be made again in the GUI. It may also have been
+            # withdrawn, e.g. by deleting the file.
+            if isfile(file_name):
+                logger.exception("Could not read transcript for summary")
+                os.remove(file_name)
+            summary_claims.discard(claim)
+            summaries.release(ROOT, user_id, file, claim)
+            continue
+        try:
+            summary = cached_summary(content_out, llm_state)
+        except Exception as e:
+            logger.exception("Summarization failed")
+            summary = "Zusammenfassung fehlgeschlagen. Bitte versuche es erneut."
+        try:
+            if isfile(file_name):
+                write_content_summary(summary, lines, file_name.replace(".todosummary", ".summary"))
+                os.remove(file_name)
+        except Exception as e:
+            logger.exception("Could not write summary")
+        finally:
+            summary_claims.discard(claim)
+            summaries.release(ROOT, user_id, file, claim)
+        llm_state["used"] = time.time()
+        logger.info(f"Summarizing done")
+
+
 if __name__ == "__main__":
     WHISPER_DEVICE = "cpu" if DEVICE == "mps" else DEVICE
-    if WHISPER_DEVICE == "cpu":
+    if COMPUTE_TYPE:
+        compute_type = COMPUTE_TYPE
+    elif DEVICE == "cpu":
+        compute_type = "int8"
+    elif WHISPER_DEVICE == "cpu":
         compute_type = "float32"
     else:
         compute_type = "float16"
 
+    if DEVICE == "mps" and WORKERS > 1:
+        logger.warning("Only one worker is supported on MPS")
+        WORKERS = 1
+    if DEVICE == "mps":
+        TRACK_WORKERS = 1
+
     # Load models
     whisperx_model = (
         "tiny.en" if DEVICE == "mps" else "large-v3"
     )  # we can load a really small one for mps, because we use mlx_whisper later and only need whisperx for diarization and alignment
-    if ONLINE:
-        model = whisperx.load_model(
-            whisperx_model, WHISPER_DEVICE, compute_type=compute_type
+    download_root = None if ONLINE else join("models", "whisperx")
+    threads = max(1, os.cpu_count() // WORKERS)
+    # On CPU, Whisper, torch and the language model each get their own cores instead of competing for all of them
+    cores = cpu_split() if DEVICE == "cpu" and TRANSCRIPTION else {}
+    if cores:
+        logger.info(f"Cores: {cores}")
+        # Every CTranslate2 worker gets its own share of the cores
+        threads = max(1, len(cores["asr"]) // (WORKERS * TRACK_WORKERS))
+        torch.set_num_threads(len(cores["torch"]))
+        torch.set_num_interop_threads(1)
+        # The threads of CTranslate2 are started when the model is loaded and stay on these cores
+        pin(cores["asr"])
+    # Cached transcripts are only reused with the same models
+    MODEL_ID = f"{whisperx_model}/{compute_type}/{DEVICE}/pyannote/speaker-diarization"
+
+    if TRANSCRIPTION:
+        # The models are loaded once and shared by all worker slots. CTranslate2 runs up to
+        # WORKERS transcriptions, each with up to TRACK_WORKERS tracks, in parallel on the same weights.
+        whisper_model = WhisperModel(
+            whisperx_model,
+            device=WHISPER_DEVICE,
+            compute_type=compute_type,
+            download_root=download_root,
+            cpu_threads=threads,
+            num_workers=WORKERS * TRACK_WORKERS,
         )
-    else:
         model = whisperx.load_model(
             whisperx_model,
             WHISPER_DEVICE,
             compute_type=compute_type,
-            download_root=join("models", "whisperx"),
+            download_root=download_root,
+            model=whisper_model,
+            threads=threads,
         )
 
-    model.model.get_prompt = types.MethodType(get_prompt, model.model)
-    diarize_model = Pipeline.from_pretrained(
-        "pyannote/speaker-diarization", use_auth_token=os.getenv("HF_AUTH_TOKEN")
-    ).to(torch.device(DEVICE))
-
-    if SUMMARIZATION:
-        model_name_or_path = "bartowski/Qwen2.5-7B-Instruct-1M-GGUF"
-        model_basename = "Qwen2.5-7B-Instruct-1M-Q6_K.gguf"
-        model_path = hf_hub_download(
-            repo_id=model_name_or_path, filename=model_basename
-        )
-
-        # Initialize the Llama instance
-        llm = Llama(
-            model_path=model_path,
-            n_ctx=32768,
-            n_gpu_layers=0,
-            n_threads=8,
-            use_mmap=True,
-            use_mlock=False,
-            verbose=False,
-        )
-        encoder = AutoTokenizer.from_pretrained("Qwen/Qwen-7B", trust_remote_code=True)
+        model.model.get_prompt = types.MethodType(get_prompt, model.model)
+        pin(cores.get("torch"))
+        # mlx_whisper does not use the batch size
+        if AUTOTUNE and DEVICE != "mps":
+            hardware = torch.cuda.get_device_name() if WHISPER_DEVICE == "cuda" else f"cpu-{socket.gethostname()}"
+            BATCH_SIZE = tuned_batch_size(model, f"{hardware}/{whisperx_model}/{compute_type}")
+        logger.info(f"Batch size: {BATCH_SIZE}")
+        diarize_model = Pipeline.from_pretrained(
+            "pyannote/speaker-diarization", use_auth_token=os.getenv("HF_AUTH_TOKEN")
+        ).to(torch.device(DEVICE))
 
     # Create necessary directories
     for directory in ["data/in/", "data/out/", "data/error/", "data/worker/"]:
@@ -296,193 +1003,30 @@ if __name__ == "__main__":
     logger.info(disclaimer)
     logger.info("Worker ready")
 
-    while True:
-        try:
-            files_sorted_by_date = oldest_files(join(ROOT, "data", "in"))
-        except Exception as e:
-            logger.exception("Error accessing input directory")
-            time.sleep(1)
-            continue
-
-        for file_name in files_sorted_by_date:
-            file = basename(file_name)
-            user_id = normpath(dirname(file_name)).split(os.sep)[-1]
-
-            if file == "hotwords.txt" or file == "language.txt":
-                continue
-
-            file_name_viewer = join(ROOT, "data", "out", user_id, file + ".html")
-
-            # Skip files that have already been processed
-            if not isfile(file_name) or isfile(file_name_viewer):
-                continue
-
-            language_file = join(ROOT, "data", "in", user_id, "language.txt")
-            if isfile(language_file):
-                with open(language_file, "r") as h:
-                    language = h.read()
-            else:
-                language = "de"
-
-            # Check if it's a zip file
-            if file_name.lower().endswith(".zip"):
+    if TRANSCRIPTION:
+        conn = jobs.connect(ROOT)
+        logger.info(f"Added {jobs.sync(conn, ROOT, partial(time_estimate, online=ONLINE))} files to the job queue")
+        if ALIGN_PRELOAD:
+            for language in jobs.common_languages(conn, ALIGN_CACHE_SIZE):
                 try:
-                    zip_extract_dir = join(ROOT, "data", "worker", "zip")
-                    shutil.rmtree(zip_extract_dir, ignore_errors=True)
-                    os.makedirs(zip_extract_dir, exist_ok=True)
-
-                    with zipfile.ZipFile(file_name, "r") as zip_ref:
-                        zip_ref.extractall(zip_extract_dir)
-
-                    multi_mode = True
-                    data_parts = []
-                    estimated_time = 0
-                    data = []
-                    file_parts = []
-
-                    # Collect files from zip
-                    for root, _, filenames in os.walk(zip_extract_dir):
-                        audio_files = [
-                            fn for fn in filenames if fnmatch.fnmatch(fn, "*.*")
-                        ]
-                        for filename in audio_files:
-                            file_path = join(root, filename)
-                            est_time_part, _ = time_estimate(file_path, ONLINE)
-                            estimated_time += est_time_part
-
-                    progress_file_name = join(
-                        ROOT,
-                        "data",
-                        "worker",
-                        user_id,
-                        f"{estimated_time}_{int(time.time())}_{file}",
-                    )
-                    with open(progress_file_name, "w") as f:
-                        f.write("")
-
-                    isolate_voices([join(root, filename) for filename in audio_files])
-
-                    # Transcribe each file
-                    for track, filename in enumerate(audio_files):
-                        file_path = join(root, filename)
-                        file_parts.append(f'-i "{file_path}"')
-                        data_part, _, _ = transcribe_file(
-                            file_path,
-                            multi_mode=True,
-                            multi_mode_track=track,
-                            language=language,
-                        )
-
-                        data_parts.append(data_part)
-
-                    # Merge data
-                    while any(data_parts):
-                        earliest = min(
-                            [(i, dp[0]) for i, dp in enumerate(data_parts) if dp],
-                            key=lambda x: x[1]["start"],
-                            default=(None, None),
-                        )
-                        if earliest[0] is None:
-                            break
-
-                        data.append(earliest[1])
-                        data_parts[earliest[0]].pop(0)
-
-                    # Merge audio files
-                    output_audio = join(ROOT, "data", "worker", "zip", "tmp.mp4")
-                    ffmpeg_input = " ".join(file_parts)
-                    ffmpeg_cmd = f'ffmpeg {ffmpeg_input} -filter_complex amix=inputs={len(file_parts)}:duration=first "{output_audio}"'
-                    os.system(ffmpeg_cmd)
-
-                    # Process merged audio
-                    file_name_out = join(ROOT, "data", "out", user_id, file + ".mp4")
-                    exit_status = os.system(
-                        f'ffmpeg -y -i "{output_audio}" -filter:v scale=320:-2 -af "lowpass=3000,highpass=200" "{file_name_out}"'
-                    )
-                    if exit_status == 256:
-                        exit_status = os.system(
-                            f'ffmpeg -y -i "{output_audio}" -c:v copy -af "lowpass=3000,highpass=200" "{file_name_out}"'
-                        )
-                    if not exit_status == 0:
-                        logger.exception("ffmpeg error during audio processing")
-                        file_name_out = output_audio  # Fallback to original fileue)
-
-                    shutil.rmtree(zip_extract_dir, ignore_errors=True)
+                    load_align_model(language, DEVICE)
                 except Exception as e:
-                    logger.exception("Transcription failed for zip file")
-                    report_error(
-                        file_name,
-                        join(ROOT, "data", "error", user_id, file),
-                        user_id,
-                        "Transkription fehlgeschlagen",
-                    )
-                    continue
-            else:
-                # Single file transcription
-                data, estimated_time, progress_file_name = transcribe_file(
-                    file_name, language=language
-                )
-
-            if data is None:
-                continue
+                    logger.exception(f"Could not preload alignment model for {language}")
+        conn.close()
 
-            # Generate outputs
-            try:
-                file_name_out = join(ROOT, "data", "out", user_id, file + ".mp4")
-
-                srt = create_srt(data)
-                viewer = create_viewer(data, file_name_out, True, False, ROOT, language)
-
-                file_name_srt = join(ROOT, "data", "out", user_id, file + ".srt")
-                with open(file_name_viewer, "w", encoding="utf-8") as f:
-                    f.write(viewer)
-                with open(file_name_srt, "w", encoding="utf-8") as f:
-                    f.write(srt)
-
-                logger.info(f"Estimated Time: {estimated_time}")
-            except Exception as e:
-                logger.exception("Error creating editor")
-                report_error(
-                    file_name,
-                    join(ROOT, "data", "error", user_id, file),
-                    user_id,
-                    "Fehler beim Erstellen des Editors",
-                )
-
-            if progress_file_name and os.path.exists(progress_file_name):
-                os.remove(progress_file_name)
-            if DEVICE == "mps":
-                print("Exiting worker to prevent memory leaks with MPS...")
-                exit(
-                    0
-                )  # Due to memory leak problems, we restart the worker after each transcription
-
-            break  # Process one file at a time
-
-        try:
-            files_sorted_by_date = oldest_files(join(ROOT, "data", "out"))
-        except Exception as e:
-            logger.exception("Error accessing input directory")
-            time.sleep(1)
-            continue
-
-        if SUMMARIZATION:
-            for file_name in files_sorted_by_date:
-                if file_name.endswith(".todosummary"):
-                    logger.info(f"Summarizing file")
-                    try:
-                        content_out, lines = read_content_summary(file_name)
-                        summary = summarize(content_out, llm, encoder)
-                    except Exception as e:
-                        logger.exception("Summarization failed")
-                        summary = (
-                            "Zusammenfassung fehlgeschlagen. Bitte versuche es erneut."
-                        )
-                    write_content_summary(
-                        summary, lines, file_name.replace(".todosummary", ".summary")
-                    )
-                    os.remove(file_name)
-                    logger.info(f"Summarizing done")
-                    break
-
-        time.sleep(1)
+    # The threads started from here on inherit the affinity, they pin themselves where needed
+    pin(cores.get("all"))
+    threading.Thread(target=heartbeat, daemon=True).start()
+    # Summaries have their own threads, so a long summary does not hold up the transcriptions and vice versa
+    if SUMMARIZATION:
+        logger.info(f"Added {summaries.sync(ROOT)} files to the summary queue")
+        for index in range(SUMMARY_WORKERS):
+            threading.Thread(target=run_summarizer, args=(index,), daemon=True).start()
+    if TRANSCRIPTION:
+        for index in range(1, WORKERS):
+            threading.Thread(target=run_worker, args=(index,), daemon=True).start()
+        run_worker(0)
+    elif SUMMARIZATION:
+        threading.Event().wait()
+    else:
+        logger.warning("Neither TRANSCRIPTION nor SUMMARIZATION is enabled")